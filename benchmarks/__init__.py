@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарки Scoring API.
+
+python -m benchmarks.stages - пропускная способность и задержки отдельных этапов обработки запроса
+python -m benchmarks.load   - нагрузочный тест запущенного локально сервера
+
+Результаты печатаются в stdout (или в файл -o) в формате JSON, чтобы их можно было сравнивать между запусками.
+"""
+
+import sys
+import json
+import platform
+
+from timeit import default_timer
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    """
+    Сводная статистика по списку задержек в секундах
+    :param list latencies:
+    :param float elapsed: общее время измерения
+    :return dict:
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "count": count,
+        "ops_per_sec": count / elapsed if elapsed else None,
+        "mean_us": sum(latencies) / count * 1e6 if count else None,
+        "p50_us": percentile(latencies, 50) * 1e6 if count else None,
+        "p90_us": percentile(latencies, 90) * 1e6 if count else None,
+        "p99_us": percentile(latencies, 99) * 1e6 if count else None,
+        "max_us": latencies[-1] * 1e6 if count else None,
+    }
+
+
+def measure(func, number, *args):
+    """
+    Вызывает func(*args) number раз и возвращает статистику задержек
+    """
+    latencies = []
+    append = latencies.append
+    timer = default_timer
+    started = timer()
+    for _ in xrange(number):
+        t = timer()
+        func(*args)
+        append(timer() - t)
+    return summarize(latencies, timer() - started)
+
+
+def environment():
+    from scoring_api import codec
+    return {"python": sys.version.split()[0], "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "json_backend": codec.BACKEND}
+
+
+def emit(results, output=None):
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f:
+            f.write(data + "\n")
+    else:
+        sys.stdout.write(data + "\n")
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Нагрузочный тест: запускает сервер в отдельном процессе и обращается к нему из нескольких потоков
+по постоянным соединениям со смесью запросов online_score и clients_interests.
+"""
+
+import json
+import time
+import random
+import socket
+import httplib
+import logging
+import threading
+import multiprocessing
+
+from optparse import OptionParser
+
+from scoring_api import api, aio, server, store
+from benchmarks import summarize, environment, emit, payloads
+
+
+def parse_mix(mix):
+    """
+    Разбирает смесь запросов вида online_score:9,clients_interests:1
+    :param str mix:
+    :return list: пары (имя, вес)
+    """
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        if name not in payloads.PAYLOADS:
+            raise ValueError("Unknown payload {}".format(name))
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+def choose(weights):
+    total = sum(w for _, w in weights)
+    point = random.uniform(0, total)
+    for name, weight in weights:
+        point -= weight
+        if point <= 0:
+            return name
+    return weights[-1][0]
+
+
+def run_server(port, frontend, threads, nclients, ready):
+    logging.basicConfig(level=logging.WARNING)
+    s = store.LRUStore()
+    payloads.seed_store(s, nclients)
+    if frontend == "aio":
+        httpd = aio.AsyncHTTPServer(("localhost", port), store=s, threads=threads)
+    else:
+        api.MainHTTPHandler.store = s
+        api.MainHTTPHandler.log_message = lambda *args: None
+        httpd = server.make_server(("localhost", port), api.MainHTTPHandler, threads=threads)
+    ready.set()
+    server.serve(httpd) if frontend != "aio" else httpd.serve_forever()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Client(threading.Thread):
+    def __init__(self, port, bodies, weights, deadline):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.port = port
+        self.bodies = bodies
+        self.weights = weights
+        self.deadline = deadline
+        self.latencies = dict((name, []) for name in bodies)
+        self.errors = 0
+
+    def run(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=30)
+        while time.time() < self.deadline:
+            name = choose(self.weights)
+            started = time.time()
+            try:
+                conn.request("POST", "/method/", self.bodies[name], {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                data = response.read()
+                if response.status != api.OK or json.loads(data)["code"] != api.OK:
+                    self.errors += 1
+            except (socket.error, httplib.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = httplib.HTTPConnection("localhost", self.port, timeout=30)
+                continue
+            self.latencies[name].append(time.time() - started)
+        conn.close()
+
+
+def run(frontend, server_threads, concurrency, duration, mix, nclients):
+    weights = parse_mix(mix)
+    bodies = {}
+    for name, _ in weights:
+        request = payloads.PAYLOADS[name](nclients) if name == "clients_interests" else payloads.PAYLOADS[name]()
+        bodies[name] = json.dumps(request)
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_server, args=(port, frontend, server_threads, nclients, ready))
+    process.start()
+    try:
+        ready.wait(10)
+        time.sleep(0.2)
+        started = time.time()
+        clients = [Client(port, bodies, weights, started + duration) for _ in range(concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - started
+    finally:
+        process.terminate()
+        process.join()
+
+    results = {}
+    everything = []
+    for name in bodies:
+        latencies = sum((client.latencies[name] for client in clients), [])
+        everything.extend(latencies)
+        results[name] = summarize(latencies, elapsed)
+    results["total"] = summarize(everything, elapsed)
+    results["total"]["errors"] = sum(client.errors for client in clients)
+    return results
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-f", "--frontend", action="store", default="threaded", choices=["threaded", "aio"])
+    op.add_option("-t", "--server-threads", action="store", type=int, default=8)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-d", "--duration", action="store", type=float, default=10)
+    op.add_option("-m", "--mix", action="store", default="online_score:9,clients_interests:1")
+    op.add_option("-n", "--clients", action="store", type=int, default=100,
+                  help="client_ids in clients_interests payload")
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+    emit({"benchmark": "load", "environment": environment(), "options": vars(opts),
+          "results": run(opts.frontend, opts.server_threads, opts.concurrency, opts.duration, opts.mix,
+                         opts.clients)}, opts.output)
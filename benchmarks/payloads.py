@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import hashlib
+
+from scoring_api import api, scoring
+
+
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+
+
+def make_request(method, arguments, login=LOGIN):
+    request = {"account": ACCOUNT, "login": login, "method": method, "arguments": arguments}
+    request["token"] = hashlib.sha512(ACCOUNT + login + api.SALT).hexdigest()
+    return request
+
+
+def online_score():
+    return make_request("online_score", {
+        "phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": u"Иван", "last_name": u"Иванов",
+        "birthday": "01.01.1990", "gender": 1,
+    })
+
+
+def clients_interests(nclients):
+    return make_request("clients_interests", {"client_ids": range(nclients), "date": "20.07.2017"})
+
+
+def seed_store(store, nclients):
+    interests = scoring.INTERESTS
+    for cid in range(nclients):
+        store.set("i:%s" % cid, json.dumps(random.sample(interests, 2)))
+
+
+PAYLOADS = {
+    "online_score": online_score,
+    "clients_interests": clients_interests,
+}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Замеры отдельных этапов обработки запроса: разбор JSON, разбор MethodRequest, авторизация, проверка аргументов,
+скоринг, получение интересов и сериализация ответа.
+"""
+
+import json
+
+from optparse import OptionParser
+
+from scoring_api import api, codec, scoring, store
+from benchmarks import measure, environment, emit, payloads
+
+
+def run(number, nclients):
+    s = store.LRUStore()
+    payloads.seed_store(s, nclients)
+    small = payloads.online_score()
+    large = payloads.clients_interests(nclients)
+    small_raw, large_raw = json.dumps(small), json.dumps(large)
+
+    mr = api.get_parsed_request({"body": small})
+    score_args = small["arguments"]
+    interests_args = large["arguments"]
+    score_req = api.OnlineScoreRequest(score_args)
+    interests = scoring.get_interests_many(s, interests_args["client_ids"])
+    small_response = {"response": {"score": 5.0}, "code": api.OK}
+    large_response = {"response": interests, "code": api.OK}
+    large_number = max(1, number // 100)
+
+    rows = [dict(score_args, phone=None) if i % 2 else score_args for i in xrange(nclients)]
+    presence = scoring.get_presence(rows)
+    score_fields = (score_req.phone, score_req.email, score_req.birthday, score_req.gender, score_req.first_name,
+                    score_req.last_name)
+
+    handle_small = lambda: api.method_handler({"body": small, "headers": {}}, {}, s)
+    api.response_cache.configure(maxsize=0)
+    uncached = measure(handle_small, number)
+    api.response_cache.configure()
+    cached = measure(handle_small, number)
+
+    return {
+        "decode.online_score": measure(codec.loads, number, small_raw),
+        "decode.clients_interests": measure(codec.loads, large_number, large_raw),
+        "get_parsed_request": measure(api.get_parsed_request, number, {"body": small}),
+        "check_auth": measure(api.check_auth, number, mr),
+        "validate.online_score": measure(api.OnlineScoreRequest, number, score_args),
+        "validate.clients_interests": measure(api.ClientsInterestsRequest, large_number, interests_args),
+        "get_score": measure(scoring.get_score, number, None, *score_fields),
+        "get_score.cached": measure(scoring.get_score, number, s, *score_fields),
+        "get_presence": measure(scoring.get_presence, large_number, rows),
+        "get_scores": measure(scoring.get_scores, large_number, *presence),
+        "get_interests_many": measure(scoring.get_interests_many, large_number, s, interests_args["client_ids"]),
+        "encode.online_score": measure(codec.encode_response, number, small_response),
+        "encode.clients_interests": measure(codec.encode_response, large_number, large_response),
+        "method_handler.online_score": uncached,
+        "method_handler.online_score.cached": cached,
+    }
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=10000,
+                  help="iterations for small payloads, large payloads use number / 100")
+    op.add_option("-c", "--clients", action="store", type=int, default=1000,
+                  help="client_ids in clients_interests payload")
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+    emit({"benchmark": "stages", "environment": environment(), "number": opts.number, "clients": opts.clients,
+          "results": run(opts.number, opts.clients)}, opts.output)
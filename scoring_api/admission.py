@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ограничение нагрузки: общее число одновременно обрабатываемых запросов, а также частота (token bucket)
+и число одновременных запросов для каждого аккаунта. Запросы сверх лимитов отклоняются сразу, до проверки
+аргументов и скоринга, поэтому всплеск трафика одного партнёра не увеличивает задержки остальных.
+"""
+
+import time
+import threading
+
+from lru import LRUCache
+from metrics import registry
+
+
+ACCOUNTS_SIZE = 10000
+# Причины отказа
+IN_FLIGHT = "in_flight"
+RATE = "rate"
+CONCURRENCY = "concurrency"
+
+
+class AccountState(object):
+    """Token bucket и число выполняющихся запросов одного аккаунта"""
+    __slots__ = ("tokens", "updated", "active")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.active = 0
+
+
+class AdmissionControl(object):
+    """
+    Все лимиты по умолчанию выключены (0).
+    :param int max_in_flight: максимум одновременно обрабатываемых запросов на процесс
+    :param float rate: запросов в секунду на аккаунт
+    :param int burst: ёмкость token bucket аккаунта, по умолчанию равна rate
+    :param int concurrency: максимум одновременно выполняющихся запросов аккаунта
+    """
+
+    def __init__(self, max_in_flight=0, rate=0, burst=0, concurrency=0):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.configure(max_in_flight, rate, burst, concurrency)
+
+    def configure(self, max_in_flight=0, rate=0, burst=0, concurrency=0):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.concurrency = concurrency
+        self.accounts = LRUCache(ACCOUNTS_SIZE)
+
+    def enter(self):
+        """
+        Учитывает запрос в общем числе обрабатываемых
+        :return bool: False, если лимит исчерпан и запрос нужно отклонить
+        """
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                registry.inc("scoring_admission_rejected_total", (("reason", IN_FLIGHT),))
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def acquire(self, account):
+        """
+        Проверяет лимиты аккаунта и учитывает запрос в числе его выполняющихся запросов
+        :param account: ключ аккаунта
+        :return str: None, если запрос допущен, иначе причина отказа. После допуска нужно вызвать release().
+        """
+        if not self.rate and not self.concurrency:
+            return None
+        now = time.time()
+        with self.lock:
+            state = self.accounts.get(account)
+            if state is None:
+                state = AccountState(self.burst, now)
+                self.accounts.set(account, state)
+            reason = None
+            if self.concurrency and state.active >= self.concurrency:
+                reason = CONCURRENCY
+            elif self.rate:
+                tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+                state.updated = now
+                if tokens < 1:
+                    state.tokens = tokens
+                    reason = RATE
+                else:
+                    state.tokens = tokens - 1
+            if reason is None:
+                state.active += 1
+        if reason is not None:
+            registry.inc("scoring_admission_rejected_total", (("reason", reason),))
+        return reason
+
+    def release(self, account):
+        if not self.rate and not self.concurrency:
+            return
+        with self.lock:
+            state = self.accounts.get(account)
+            if state is not None and state.active > 0:
+                state.active -= 1
+
+    def limits(self):
+        return [((("limit", "max_in_flight"),), self.max_in_flight), ((("limit", "rate"),), self.rate),
+                ((("limit", "burst"),), self.burst), ((("limit", "concurrency"),), self.concurrency)]
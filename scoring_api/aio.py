@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Асинхронный фронтенд Scoring API на основе цикла событий asyncore.
+
+Каждое соединение - это объект в цикле событий, а не поток, поэтому тысячи простаивающих keep-alive
+соединений почти ничего не стоят. Запросы разбираются по HTTP/1.1 и передаются в тот же router, что
+и у MainHTTPHandler. Обработчики с обращениями к хранилищу можно выполнять в пуле потоков (--threads),
+тогда цикл событий продолжает обслуживать сеть, пока идут запросы к хранилищу.
+"""
+
+import os
+import time
+import socket
+import asyncore
+import asynchat
+import logging
+import mimetools
+import threading
+
+from collections import deque
+from cStringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+
+import api
+from api import MainHTTPHandler, process_request, reject_request, encode_response, get_metrics, BAD_REQUEST, \
+    NOT_FOUND, OK, REQUEST_TIMEOUT, REQUEST_ENTITY_TOO_LARGE, ERRORS, METRICS_CONTENT_TYPE, MAX_BODY_SIZE, BODY_TIMEOUT, \
+    TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE, INTERNAL_ERROR, RETRY_AFTER
+from metrics import registry
+
+
+# Сколько кусков потокового ответа может ждать отправки в цикле событий
+STREAM_WINDOW = 4
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Позволяет другим потокам поставить вызов в очередь цикла событий и разбудить его через pipe.
+    """
+
+    def __init__(self, socket_map):
+        self.callbacks = deque()
+        self.lock = threading.Lock()
+        r, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map=socket_map)
+        os.close(r)
+
+    def call(self, callback, *args):
+        self.callbacks.append((callback, args))
+        with self.lock:
+            os.write(self.wfd, "x")
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def handle_close(self):
+        self.close()
+        os.close(self.wfd)
+
+
+def frame(chunk, chunked):
+    return "%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk
+
+
+class StreamProducer(object):
+    """
+    Producer для asynchat, который отдаёт ответ заранее неизвестной длины по мере его формирования.
+    Используется, когда обработчики выполняются в цикле событий.
+    """
+
+    def __init__(self, chunks, chunked):
+        self.stream = chunks
+        self.chunks = iter(chunks)
+        self.chunked = chunked
+        self.done = False
+
+    def more(self):
+        if self.done:
+            return ""
+        for chunk in self.chunks:
+            if chunk:
+                return frame(chunk, self.chunked)
+        self.done = True
+        self.stream.close()
+        return "0\r\n\r\n" if self.chunked else ""
+
+
+class StreamWindow(object):
+    """
+    Ограничивает число кусков потокового ответа, которые поток пула передал в цикл событий, а соединение
+    ещё не взяло на отправку: медленный клиент не заставляет копить ответ в памяти, а придерживает поток пула.
+    :param int size:
+    """
+
+    def __init__(self, size=STREAM_WINDOW):
+        self.cond = threading.Condition()
+        self.free = size
+        self.closed = False
+
+    def acquire(self):
+        """
+        Ждёт места для следующего куска
+        :return bool: False, если соединение закрыто и отправлять больше некуда
+        """
+        with self.cond:
+            while self.free <= 0 and not self.closed:
+                self.cond.wait()
+            self.free -= 1
+            return not self.closed
+
+    def release(self):
+        with self.cond:
+            self.free += 1
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ChunkProducer(object):
+    """
+    Producer одного куска потокового ответа, который освобождает место в окне, когда соединение берёт кусок на отправку
+    """
+
+    def __init__(self, data, window):
+        self.data = data
+        self.window = window
+
+    def more(self):
+        data, self.data = self.data, ""
+        if data:
+            self.window.release()
+        return data
+
+
+class HTTPChannel(asynchat.async_chat):
+    """
+    Одно HTTP соединение. Запросы, пришедшие по соединению подряд (pipelining), обрабатываются
+    строго по очереди, и ответы отправляются в порядке поступления запросов.
+    """
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.buffer = []
+        self.request = None
+        self.pending = deque()
+        self.busy = False
+        self.closing = False
+        self.requests_served = 0
+        self.last_activity = time.time()
+        self.body_deadline = None
+        # Отправляемый потоковый ответ: закрывается, если соединение закроется раньше, чем ответ будет отправлен
+        self.stream = None
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data, self.buffer = "".join(self.buffer), []
+        if self.closing:
+            return
+        if self.request is None:
+            self.parse_head(data)
+        else:
+            self.request["body"] = data
+            self.enqueue()
+
+    def parse_head(self, data):
+        lines = data.lstrip("\r\n").split("\r\n", 1)
+        words = lines[0].split()
+        if len(words) != 3:
+            self.send_error(BAD_REQUEST, "Bad request line")
+            return
+        command, path, version = words
+        headers = mimetools.Message(StringIO(lines[1] if len(lines) > 1 else ""))
+        connection = headers.get("Connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        self.request = {"command": command, "path": path, "version": version, "headers": headers,
+                        "keep_alive": keep_alive, "body": None}
+
+        length = headers.get("Content-Length")
+        if length is not None:
+            try:
+                length = int(length)
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                self.send_error(BAD_REQUEST, "Bad Content-Length")
+                return
+        if length > self.server.max_body_size:
+            self.reject(REQUEST_ENTITY_TOO_LARGE)
+        elif length:
+            self.body_deadline = time.time() + self.server.body_timeout
+            self.set_terminator(length)
+        else:
+            self.request["body"] = "" if length == 0 else None
+            self.enqueue()
+
+    def enqueue(self):
+        if self.closing:
+            return
+        self.pending.append(self.request)
+        self.request = None
+        self.body_deadline = None
+        self.set_terminator("\r\n\r\n")
+        self.dispatch()
+
+    def dispatch(self):
+        if self.busy or not self.pending:
+            return
+        self.busy = True
+        request = self.pending.popleft()
+        if "reject" in request:
+            context = {"request_id": MainHTTPHandler.get_request_id(request["headers"])}
+            self.respond(request, *reject_request(request["reject"], context, request["message"]))
+        elif request["command"] == "GET":
+            if request["path"].split("?", 1)[0].strip("/") == "metrics":
+                self.send_body(request, OK, METRICS_CONTENT_TYPE, get_metrics())
+            else:
+                self.respond(request, NOT_FOUND, {"error": ERRORS[NOT_FOUND], "code": NOT_FOUND})
+        elif request["command"] != "POST":
+            self.respond(request, 501, {"error": "Unsupported method ({})".format(request["command"]), "code": 501})
+        elif self.server.pool is None:
+            self.respond(request, *self.server.process(request))
+        elif self.server.queue_size and self.server.queued >= self.server.queue_size:
+            registry.inc("scoring_admission_rejected_total", (("reason", "queue"),))
+            context = {"request_id": MainHTTPHandler.get_request_id(request["headers"])}
+            self.respond(request, *reject_request(SERVICE_UNAVAILABLE, context))
+        else:
+            self.server.queued += 1
+            self.server.pool.apply_async(self.work, (request,))
+
+    def work(self, request):
+        """
+        Выполняется в потоке пула: обрабатывает запрос, кодирует ответ и передаёт его в цикл событий.
+        Потоковый ответ читается здесь же по мере отправки, поэтому обращения к хранилищу не блокируют цикл
+        событий, а запрос остаётся в числе обрабатываемых, пока ответ не отправлен.
+        """
+        call = self.server.trigger.call
+        try:
+            code, r = self.server.process(request)
+            chunks = encode_response(r)
+        except Exception, e:
+            logging.exception(u"Unexpected error: %s" % e)
+            code = INTERNAL_ERROR
+            chunks = encode_response({"error": ERRORS[INTERNAL_ERROR], "code": INTERNAL_ERROR})
+        if isinstance(chunks, list):
+            call(self.processed, request, code, chunks)
+            return
+
+        chunked = request["version"] == "HTTP/1.1"
+        window = StreamWindow()
+        call(self.start_stream, request, code, window)
+        completed = False
+        try:
+            for chunk in chunks:
+                if chunk:
+                    if not window.acquire():
+                        break
+                    call(self.push_chunk, frame(chunk, chunked), window)
+            else:
+                completed = True
+        except Exception, e:
+            # Заголовки уже отправлены, поэтому сообщить об ошибке можно только оборвав ответ
+            logging.exception(u"Streaming response failed: %s" % e)
+        finally:
+            chunks.close()
+            call(self.end_stream, window, completed)
+
+    def processed(self, request, code, chunks):
+        self.server.queued -= 1
+        self.send_body(request, code, "application/json", *chunks)
+
+    def respond(self, request, code, r):
+        chunks = encode_response(r)
+        if isinstance(chunks, list):
+            self.send_body(request, code, "application/json", *chunks)
+            return
+        chunked, keep_alive = self.send_stream_head(request, code)
+        if not self.connected:
+            chunks.close()
+            return
+        self.stream = chunks
+        self.push_with_producer(StreamProducer(chunks, chunked))
+        self.finish(keep_alive)
+
+    def send_stream_head(self, request, code):
+        """
+        Отправляет заголовки ответа заранее неизвестной длины: клиентам HTTP/1.1 с Transfer-Encoding: chunked,
+        остальным - до закрытия соединения
+        :return tuple: (chunked, keep_alive)
+        """
+        chunked = request["version"] == "HTTP/1.1"
+        self.requests_served += 1
+        keep_alive = chunked and request["keep_alive"] and self.requests_served < self.server.max_requests
+        if not self.connected:
+            return chunked, keep_alive
+        head = [
+            "%s %d %s" % (request["version"], code, BaseHTTPRequestHandler.responses.get(code, ("",))[0]),
+            "Content-Type: application/json",
+            "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+        ]
+        if chunked:
+            head.append("Transfer-Encoding: chunked")
+        self.push("\r\n".join(head) + "\r\n\r\n")
+        return chunked, keep_alive
+
+    def start_stream(self, request, code, window):
+        self.stream = window
+        self.stream_mode = self.send_stream_head(request, code)
+        if not self.connected:
+            window.close()
+
+    def push_chunk(self, data, window):
+        if self.connected:
+            self.push_with_producer(ChunkProducer(data, window))
+
+    def end_stream(self, window, completed):
+        self.server.queued -= 1
+        self.stream = None
+        if not self.connected:
+            return
+        if not completed:
+            self.finish(False)
+            return
+        chunked, keep_alive = self.stream_mode
+        if chunked:
+            self.push("0\r\n\r\n")
+        self.finish(keep_alive)
+
+    def send_body(self, request, code, content_type, *chunks):
+        if not self.connected:
+            return
+        self.requests_served += 1
+        keep_alive = request["keep_alive"] and self.requests_served < self.server.max_requests
+        head = [
+            "%s %d %s" % (request["version"], code, BaseHTTPRequestHandler.responses.get(code, ("",))[0]),
+            "Content-Type: %s" % content_type,
+            "Content-Length: %d" % sum(len(chunk) for chunk in chunks),
+            "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+        ]
+        if code in (TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE):
+            head.append("Retry-After: %d" % RETRY_AFTER)
+        # push() сразу пытается отправить данные, поэтому заголовки и тело отдаём одним куском
+        self.push("".join(("\r\n".join(head), "\r\n\r\n") + chunks))
+        self.finish(keep_alive)
+
+    def finish(self, keep_alive):
+        self.last_activity = time.time()
+        self.busy = False
+        if keep_alive:
+            self.dispatch()
+        else:
+            self.closing = True
+            self.pending.clear()
+            self.close_when_done()
+
+    def send_error(self, code, message):
+        """
+        Отвечает ошибкой на запрос, который не удалось разобрать, и закрывает соединение
+        """
+        self.request = {"version": "HTTP/1.1", "headers": {}}
+        self.reject(code, message)
+
+    def reject(self, code, message=None):
+        """
+        Отвечает ошибкой на запрос, тело которого не будет прочитано, и закрывает соединение
+        """
+        request, self.request = self.request, None
+        self.body_deadline = None
+        # Ответ на этот запрос должен уйти после ответов на уже принятые запросы
+        self.closing = True
+        self.pending.append(dict(request, keep_alive=False, reject=code, message=message))
+        self.dispatch()
+
+    def check_deadline(self, now):
+        """
+        Закрывает соединение, если тело запроса не получено в срок или соединение долго простаивает
+        """
+        if self.body_deadline is not None and self.body_deadline < now and not self.busy and not self.closing:
+            self.reject(REQUEST_TIMEOUT)
+        elif not self.busy and self.last_activity < now - self.server.timeout:
+            self.close()
+
+    def readable(self):
+        # Пока ответ не готов, не читаем новые запросы: так объём буферизованных данных остаётся ограниченным
+        return not self.busy and not self.closing and asynchat.async_chat.readable(self)
+
+    def handle_error(self):
+        logging.exception("Unexpected error in connection")
+        self.close()
+
+    def close(self):
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.close()
+        asynchat.async_chat.close(self)
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+    Слушающий сокет асинхронного фронтенда
+    :param tuple address:
+    :param store:
+    :param int threads: размер пула потоков для обработчиков, 0 - выполнять их в цикле событий
+    :param float timeout: через сколько секунд бездействия закрывать keep-alive соединение
+    :param int max_requests: максимальное число запросов в одном соединении
+    :param int max_body_size: тела больше этого размера отклоняются с кодом 413 не читая их
+    :param float body_timeout: за сколько секунд должно быть получено тело запроса
+    :param int queue_size: сколько запросов может ждать поток пула, остальные получают 503; 0 - без ограничения
+    """
+    router = MainHTTPHandler.router
+
+    def __init__(self, address, store=None, threads=0, timeout=60, max_requests=1000, max_body_size=MAX_BODY_SIZE,
+                 body_timeout=BODY_TIMEOUT, queue_size=0):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.server_address = self.socket.getsockname()
+        self.store = store
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.max_body_size = max_body_size
+        self.body_timeout = body_timeout
+        self.queue_size = queue_size
+        self.queued = 0
+        self.threads = threads
+        self.pool = None
+        self.trigger = None
+        self.running = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HTTPChannel(pair[0], self)
+
+    def process(self, request):
+        context = {"request_id": MainHTTPHandler.get_request_id(request["headers"])}
+        return process_request(self.router, request["path"], request["body"], request["headers"], context,
+                               self.store)
+
+    def close_idle(self):
+        now = time.time()
+        for channel in self.socket_map.values():
+            if isinstance(channel, HTTPChannel):
+                channel.check_deadline(now)
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.threads > 0:
+            self.pool = ThreadPool(self.threads)
+            self.trigger = Trigger(self.socket_map)
+        self.running = True
+        last_check = time.time()
+        try:
+            while self.running:
+                asyncore.loop(timeout=poll_interval, map=self.socket_map, count=1)
+                if time.time() - last_check > poll_interval:
+                    self.close_idle()
+                    last_check = time.time()
+        finally:
+            # Потоки пула, отдающие потоковые ответы, ждут цикл событий, который уже остановлен
+            for channel in self.socket_map.values():
+                if isinstance(channel, HTTPChannel) and channel.stream is not None:
+                    channel.stream.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def shutdown(self):
+        self.running = False
+
+    def server_close(self):
+        asyncore.close_all(map=self.socket_map)
+
+
+if __name__ == "__main__":
+    (opts, args) = api.make_option_parser().parse_args()
+    store = api.configure(opts)
+    server = AsyncHTTPServer(("localhost", opts.port), store=store, threads=opts.threads,
+                             max_body_size=opts.max_body, body_timeout=opts.body_timeout, queue_size=opts.queue_size)
+    logging.info("Starting async server at %s" % opts.port)
+    api.run(server, opts, store)
@@ -4,14 +4,33 @@
 import json
 import datetime
 import logging
+import hmac
+import time
 import hashlib
 import uuid
+import signal
+import socket
+import threading
 
 from optparse import OptionParser
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from scoring import get_score, get_interests
+from multiprocessing.pool import ThreadPool
+from BaseHTTPServer import BaseHTTPRequestHandler
+from server import make_server, serve, serve_forked
+from functools import partial
+from cStringIO import StringIO
+from scoring import get_score, get_score_key, get_interests_many, iter_interests, fetch_interests
+from store import make_store
+from snapshot import SnapshotStore, SNAPSHOT_INTERVAL
+from lru import LRUCache
+from metrics import registry
+import codec
+from logs import setup_logging, SAMPLED
+from admission import AdmissionControl
+from singleflight import SingleFlight
+from catalog import InterestCatalog
+from profiling import profiler, toggle_on_signal, PROFILE_RATE, PROFILE_ID_PREFIX
 from models import Model, CharField, ArgumentsField, EmailField, PhoneField, DateField, BirthDayField, GenderField, \
-    ClientIDsField, ValidationError, InvalidRequest, Forbidden
+    ClientIDsField, IntegerField, ValidationError, InvalidRequest, Forbidden, TooManyRequests
 
 
 SALT = "Otus"
@@ -21,15 +40,39 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_TIMEOUT = 408
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_TIMEOUT: "Request Timeout",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
+codec.register_errors(ERRORS)
+ADMIN_SCORE_RESPONSE = codec.constant({"score": 42})
+AUTH_CACHE_SIZE = 1024
+ADMIN_ROLLOVER_GRACE = 60
+RESPONSE_CACHE_SIZE = 10000
+RESPONSE_CACHE_TTL = 60
+MAX_CLIENT_IDS = 500000
+STREAM_MIN_CLIENTS = 1000
+MAX_INTEREST_CLIENTS = 10000
+MAX_BATCH_SIZE = 1000
+BATCH_THREADS = 8
+MAX_BODY_SIZE = 8 * 1024 * 1024
+BODY_TIMEOUT = 10
+# Через сколько секунд клиенту предлагается повторить отклонённый из-за нагрузки запрос
+RETRY_AFTER = 1
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -41,11 +84,23 @@ GENDERS = {
 
 
 class ClientsInterestsRequest(Model):
-    client_ids = ClientIDsField(required=True)
+    compact = True
+
+    client_ids = ClientIDsField(required=True, max_length=MAX_CLIENT_IDS)
     date = DateField(required=False, nullable=True)
 
 
+class ClientsByInterestRequest(Model):
+    compact = True
+
+    interest = CharField(required=True, nullable=False)
+    offset = IntegerField(required=False, nullable=True, min_value=0)
+    limit = IntegerField(required=False, nullable=True, min_value=1, max_value=MAX_INTEREST_CLIENTS)
+
+
 class OnlineScoreRequest(Model):
+    compact = True
+
     first_name = CharField(required=False, nullable=True)
     last_name = CharField(required=False, nullable=True)
     email = EmailField(required=False, nullable=True)
@@ -61,7 +116,15 @@ class OnlineScoreRequest(Model):
             return False
 
 
+class ProfileRequest(Model):
+    compact = True
+
+    action = CharField(required=True, nullable=False)
+
+
 class MethodRequest(Model):
+    compact = True
+
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
     token = CharField(required=True, nullable=True)
@@ -73,34 +136,218 @@ class MethodRequest(Model):
         return self.login == ADMIN_LOGIN
 
 
+class AdminDigest(object):
+    """
+    Токен администратора меняется раз в час. Дайджест текущего и предыдущего часа вычисляется один раз
+    на границе часа; первые ADMIN_ROLLOVER_GRACE секунд нового часа принимается и токен предыдущего.
+    """
+
+    def __init__(self, grace=None):
+        self.grace = datetime.timedelta(seconds=ADMIN_ROLLOVER_GRACE if grace is None else grace)
+        # (начало часа, начало следующего часа, дайджест текущего часа, дайджест предыдущего часа)
+        self.state = None
+
+    @staticmethod
+    def make_digest(hour):
+        return hashlib.sha512(hour.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+
+    def get_digests(self, now=None):
+        now = now or datetime.datetime.now()
+        state = self.state
+        if state is None or not state[0] <= now < state[1]:
+            start = now.replace(minute=0, second=0, microsecond=0)
+            state = (start, start + datetime.timedelta(hours=1), self.make_digest(start),
+                     self.make_digest(start - datetime.timedelta(hours=1)))
+            # Кортеж заменяется целиком, поэтому потоки видят либо старое, либо новое состояние
+            self.state = state
+        if now - state[0] < self.grace:
+            return state[2], state[3]
+        return state[2],
+
+
+admin_digest = AdminDigest()
+auth_cache = LRUCache(AUTH_CACHE_SIZE)
+
+
+def compare_token(digest, token):
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+    return hmac.compare_digest(digest, token)
+
+
 def check_auth(request):
+    token = request.token
+    if not token:
+        return False
     if request.is_admin:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
+        return any([compare_token(digest, token) for digest in admin_digest.get_digests()])
+
+    key = (request.account or "", request.login or "")
+    digest = auth_cache.get(key)
+    if digest is None:
+        digest = hashlib.sha512(key[0] + key[1] + SALT).hexdigest()
+        if not compare_token(digest, token):
+            return False
+        # Запоминаем только подтверждённые пары, чтобы перебор токенов не вытеснял реальных партнёров
+        auth_cache.set(key, digest)
         return True
+    return compare_token(digest, token)
+
+
+class ResponseCache(object):
+    """
+    Кэш ответов online_score. Ключ - хэш account, login, token и аргументов запроса, поэтому повтор
+    того же запроса тем же партнёром отдаётся без авторизации, проверки аргументов и скоринга: в кэш
+    попадают только ответы на запросы, прошедшие их полностью. Лимиты аккаунта проверяются и для ответов
+    из кэша. Запрос с полями, которых нет в MethodRequest,
+    в кэше не ищется и получает ошибку проверки. Запросы администратора не кэшируются.
+    :param int maxsize: максимальное число ответов, 0 - кэш выключен
+    :param int ttl: время жизни ответа в секундах
+    :param opt_out: аккаунты, ответы которым не кэшируются
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, opt_out=()):
+        self.configure(maxsize, ttl, opt_out)
+
+    def configure(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, opt_out=()):
+        self.cache = LRUCache(maxsize)
+        self.ttl = ttl
+        self.opt_out = frozenset(opt_out)
+        self.enabled = maxsize > 0 and ttl > 0
+
+    def key(self, body):
+        """
+        :param dict body: тело запроса
+        :return: ключ кэша или None, если ответ на этот запрос не кэшируется
+        """
+        if not self.enabled or not isinstance(body, dict) or body.get("method") != "online_score":
+            return None
+        if any(name not in MethodRequest.fields for name in body):
+            return None
+        account, login = body.get("account"), body.get("login")
+        if login == ADMIN_LOGIN or not isinstance(account, (basestring, type(None))) or account in self.opt_out:
+            return None
+        try:
+            raw = json.dumps([account, login, body.get("token"), body.get("arguments")], sort_keys=True,
+                             separators=(",", ":"))
+        except (TypeError, ValueError):
+            return None
+        return hashlib.md5(raw).digest()
+
+    def get(self, key):
+        value = self.cache.get(key)
+        registry.inc("scoring_response_cache_total", (("result", "miss" if value is None else "hit"),))
+        return value
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.ttl)
+
+
+response_cache = ResponseCache()
+# Каталог интересов (catalog.InterestCatalog). Если он загружен, интересы берутся из него, а не из хранилища.
+interest_catalog = None
+admission = AdmissionControl()
+# Одновременные запросы одного скоринга и интересов одних клиентов обращаются к хранилищу один раз
+score_flight = SingleFlight("score")
+interests_flight = SingleFlight("interests")
+registry.gauge("scoring_in_flight_requests", "Requests being processed", lambda: admission.in_flight)
+registry.gauge("scoring_admission_limits", "Configured admission limits, 0 means unlimited", admission.limits)
+
+
+# Буферы для чтения тел запросов, по одному на поток: растут до самого большого прочитанного тела
+read_buffers = threading.local()
+
+
+def read_buffer(size):
+    """
+    :param int size:
+    :return bytearray: буфер текущего потока не меньше size байт
+    """
+    buf = getattr(read_buffers, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = read_buffers.buf = bytearray(size)
+    return buf
+
 
-    return False
+def take_buffered(rfile, size):
+    """
+    Забирает не больше size байт, которые файл сокета уже прочитал из сокета, но ещё не отдал.
+    Зависит от устройства socket._fileobject в Python 2.7: прочитанные с запасом данные лежат в rfile._rbuf
+    (cStringIO, позиция в конце), и read/readline отдают их раньше, чем читают сокет. Поэтому остаток
+    (например, следующий запрос соединения) записывается в новый _rbuf так же, как это делает сам readline.
+    :param socket._fileobject rfile:
+    :param int size:
+    :return str:
+    """
+    data = rfile._rbuf.getvalue()
+    if not data:
+        return ""
+    rfile._rbuf = StringIO()
+    rfile._rbuf.write(data[size:])
+    return data[:size]
 
 
-def get_parsed_request(request):
+def has_buffered(rfile):
+    """
+    :param socket._fileobject rfile:
+    :return bool: есть ли в буфере rfile прочитанные из сокета данные, см. take_buffered
+    """
+    return rfile._rbuf.tell() > 0
+
+
+def observe_stage(stage, started):
+    registry.observe("scoring_stage_seconds", (("stage", stage),), time.time() - started)
+
+
+def observe_chunks(stage, chunks):
+    """
+    Отдаёт куски потокового ответа и учитывает в этапе stage суммарное время их получения
+    :param str stage:
+    :param chunks: итерируемая последовательность
+    :return: генератор
+    """
+    chunks = iter(chunks)
+    spent = 0.0
+    try:
+        while True:
+            started = time.time()
+            chunk = next(chunks, None)
+            spent += time.time() - started
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        registry.observe("scoring_stage_seconds", (("stage", stage),), spent)
+
+
+def fetch_interests_coalesced(store, client_ids):
+    # Пачка интересов, которую одновременно читают другие запросы, читается из хранилища один раз
+    return interests_flight.do_many(client_ids, partial(fetch_interests, store))
+
+
+def get_parsed_request(request, auth=check_auth):
     """
     Функция разбирает полученный запрос на структуру MethodRequest и возвращает его,
     если какое-либо поле не удовлетворяет нашим требованиям, то делает raise ошибки
     :param dict request:
+    :param auth: функция проверки авторизации
     :return MethodRequest:
     """
     body = request.get('body')
     if not body:
         raise InvalidRequest(u"Request has empty 'body'")
 
+    started = time.time()
     mr = MethodRequest(body)
+    observe_stage("validation", started)
 
     if not mr.is_valid():
         raise ValidationError(mr.errors)
 
-    if not check_auth(mr):
+    started = time.time()
+    authorized = auth(mr)
+    observe_stage("auth", started)
+    if not authorized:
         raise Forbidden(u"Wrong credentials.")
 
     return mr
@@ -114,16 +361,62 @@ def clients_interests_handler(mr, ctx, store):
     :param store:
     :return dict:
     """
+    started = time.time()
     ci = ClientsInterestsRequest(mr.arguments)
+    observe_stage("validation", started)
 
     if not ci.is_valid():
         raise ValidationError(ci.errors)
 
-    interests = {client_id: get_interests(None, client_id) for client_id in ci.client_ids}
     ctx.update({'nclients': len(ci.client_ids)})
+    catalog = interest_catalog
+    if len(ci.client_ids) >= STREAM_MIN_CLIENTS:
+        # Большой ответ отдаём по частям по мере чтения из хранилища, не собирая его в памяти.
+        # Хранилище читается уже после возврата из обработчика, пока фронтенд отправляет ответ.
+        if catalog is not None:
+            chunks = catalog.iter_many(ci.client_ids)
+        else:
+            chunks = iter_interests(store, ci.client_ids, fetch=fetch_interests_coalesced)
+        return codec.ObjectStream(observe_chunks("scoring", chunks))
+
+    started = time.time()
+    if catalog is not None:
+        interests = catalog.get_many(ci.client_ids)
+    else:
+        interests = interests_flight.do_many(ci.client_ids, partial(get_interests_many, store))
+    observe_stage("scoring", started)
     return interests
 
 
+def clients_by_interest_handler(mr, ctx, store):
+    """
+    Обработчик для запросов clients_by_interest: id клиентов с указанным интересом из каталога интересов
+    :param dict request:
+    :param dict ctx:
+    :param store:
+    :return dict:
+    """
+    started = time.time()
+    cr = ClientsByInterestRequest(mr.arguments)
+    observe_stage("validation", started)
+
+    if not cr.is_valid():
+        raise ValidationError(cr.errors)
+    catalog = interest_catalog
+    if catalog is None:
+        raise InvalidRequest(u"Interest catalog is not loaded")
+    if cr.interest not in catalog.bits:
+        raise InvalidRequest(u"Unknown interest '{}'".format(cr.interest))
+
+    started = time.time()
+    offset = cr.offset or 0
+    limit = cr.limit or MAX_INTEREST_CLIENTS
+    client_ids = catalog.clients(cr.interest, offset, limit)
+    observe_stage("scoring", started)
+    ctx.update({'nclients': len(client_ids)})
+    return {"count": catalog.count(cr.interest), "offset": offset, "client_ids": client_ids}
+
+
 def online_score_handler(mr, ctx, store):
     """
     Обработчик для запросов по скорингу online_score
@@ -132,118 +425,585 @@ def online_score_handler(mr, ctx, store):
     :param store:
     :return dict:
     """
+    started = time.time()
     score_req = OnlineScoreRequest(mr.arguments)
+    observe_stage("validation", started)
 
     if not score_req.is_valid():
         raise ValidationError(score_req.errors)
     if not score_req.validate_arguments():
         raise InvalidRequest(u"Not enough arguments in request: {}".format(mr.arguments))
 
-    if mr.is_admin:
-        score = 42
-    else:
-        score = get_score(None, score_req.phone, score_req.email, score_req.birthday, score_req.gender,
-                          score_req.first_name, score_req.last_name)
-
     ctx.update({'has': score_req.get_filled_fields()})
+    if mr.is_admin:
+        # Неизменяемый ответ администратору закодирован заранее
+        return ADMIN_SCORE_RESPONSE
+
+    started = time.time()
+    args = (score_req.phone, score_req.email, score_req.birthday, score_req.gender, score_req.first_name,
+            score_req.last_name)
+    score = score_flight.do(get_score_key(*args), get_score, store, *args)
+    observe_stage("scoring", started)
     response = {'score': score}
 
     return response
 
 
-def method_handler(request, ctx, store):
+PROFILE_ACTIONS = {
+    "start": profiler.enable,
+    "stop": profiler.disable,
+    "dump": profiler.dump,
+    "status": lambda: None,
+}
+
+
+def profile_handler(mr, ctx, store):
+    """
+    Управление профилированием, доступно только администратору.
+    action: start - включить, stop - выключить и записать статистику, dump - записать статистику, status - состояние
+    :param dict request:
+    :param dict ctx:
+    :param store:
+    :return dict:
+    """
+    if not mr.is_admin:
+        raise Forbidden(u"Method profile is available only for admin")
+    pr = ProfileRequest(mr.arguments)
+    if not pr.is_valid():
+        raise ValidationError(pr.errors)
+    if pr.action not in PROFILE_ACTIONS:
+        raise InvalidRequest(u"Unknown profile action '{}'".format(pr.action))
+    written = PROFILE_ACTIONS[pr.action]()
+    response = profiler.status()
+    if written is not None:
+        response["written"] = written
+    return response
+
+
+METHODS = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+    "clients_by_interest": clients_by_interest_handler,
+    "profile": profile_handler,
+}
+
+
+def admit(account):
+    """
+    Учитывает запрос в лимитах аккаунта. После допущенного запроса нужно вызвать admission.release(account).
+    :param tuple account: (account, login)
+    :raises TooManyRequests: если лимит аккаунта исчерпан
+    """
+    if admission.acquire(account) is not None:
+        raise TooManyRequests(u"Request limit exceeded for account '{}'".format(account[0] or account[1]))
+
+
+def method_handler(request, ctx, store, auth=check_auth):
     """
     Основной обработчик методов. Все запросы, в которых указан путь method приходят сюда
     :param dict request:
     :param dict ctx:
     :param store:
+    :param auth: функция проверки авторизации
     :return:
     """
     response, code = None, None
+    method, started = "unknown", time.time()
+    profile = profiler.start(ctx.get("request_id"))
+    try:
+        cache_key = response_cache.key(request.get('body'))
+        cached = response_cache.get(cache_key) if cache_key is not None else None
+        try:
+            if cached is not None:
+                method = "online_score"
+                body = request['body']
+                # В кэше только ответы на запросы, прошедшие авторизацию с тем же токеном, поэтому лимиты
+                # аккаунта проверяются без повторной авторизации: повторы одного партнёра тоже получают 429
+                account = (body.get("account") or "", body.get("login") or "")
+                admit(account)
+                admission.release(account)
+                response, has = cached
+                code = OK
+                ctx.update({'has': has})
+                logging.debug(u'Request: %s served from response cache. Result is: %s', request, response)
+            else:
+                # Тела запросов и ответов превращаем в строки только если включён уровень DEBUG
+                logging.debug(u'Processing request: %s', request)
+                mr = get_parsed_request(request, auth)
+                if mr.method not in METHODS:
+                    raise InvalidRequest(u"Unknown method '{}'".format(mr.method))
+                method = mr.method
+                # Лимиты проверяются после дешёвой авторизации, чтобы чужой аккаунт нельзя было исчерпать
+                # поддельными запросами, но до проверки аргументов и скоринга. Администратор не ограничивается.
+                account = None if mr.is_admin else (mr.account or "", mr.login or "")
+                if account is not None:
+                    admit(account)
+                streamed = False
+                try:
+                    response = METHODS[mr.method](mr, ctx, store)
+                    # Потоковый ответ читает хранилище после возврата из обработчика, поэтому запрос
+                    # аккаунта считается выполняющимся, пока поток не прочитан или не закрыт
+                    streamed = account is not None and isinstance(response, codec.ObjectStream)
+                    if streamed:
+                        response.on_close(partial(admission.release, account))
+                finally:
+                    if account is not None and not streamed:
+                        admission.release(account)
+                code = OK
+                logging.debug(u'Request: %s successfully processed. Result is: %s', request, response)
+
+        except InvalidRequest, error:
+            logging.error(u'%s', error)
+            response, code = error.message, INVALID_REQUEST
+        except Forbidden, error:
+            response, code = error.message, FORBIDDEN
+        except TooManyRequests, error:
+            response, code = error.message, TOO_MANY_REQUESTS
+        except ValidationError, error:
+            response, code = error.message, INVALID_REQUEST
+
+        if code == OK and cache_key is not None and cached is None:
+            response_cache.set(cache_key, (response, ctx.get('has')))
+    finally:
+        # Профилирование останавливается и при непредвиденном исключении, иначе оно осталось бы включённым
+        # в этом потоке для всех следующих запросов. Код не задан, только если исключение не обработано:
+        # его превратит в ответ 500 process_request, а в метриках метода он учитывается здесь.
+        if profile is not None:
+            profiler.stop(profile, method)
+        registry.inc("scoring_method_requests_total", (("method", method), ("code", code or INTERNAL_ERROR)))
+        registry.observe("scoring_method_seconds", (("method", method),), time.time() - started)
+    return response, code
+
+
+def cached_auth(cache):
+    """
+    Возвращает функцию проверки авторизации, которая запоминает результат check_auth в cache
+    для каждой тройки account, login, token
+    :param dict cache:
+    :return:
+    """
+    def auth(request):
+        key = (request.account, request.login, request.token)
+        if key not in cache:
+            cache[key] = check_auth(request)
+        return cache[key]
+    return auth
+
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
 
-    METHODS = {
-        "online_score": online_score_handler,
-        "clients_interests": clients_interests_handler,
-    }
 
+def get_batch_pool():
+    # Пул создаётся при первом параллельном пакете, чтобы в режиме с fork() он появлялся уже в воркере
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPool(BATCH_THREADS)
+    return _batch_pool
+
+
+def batch_handler(request, ctx, store):
+    """
+    Обработчик пакетных запросов. Все запросы, в которых указан путь batch приходят сюда.
+    Тело - список запросов в формате method, либо словарь {"requests": [...], "parallel": true}.
+    Результаты возвращаются списком {"code": ..., "response": ...} в порядке запросов.
+    :param dict request:
+    :param dict ctx:
+    :param store:
+    :return:
+    """
+    body, parallel = request.get('body'), False
+    if isinstance(body, dict):
+        body, parallel = body.get('requests'), bool(body.get('parallel'))
+    if not body or not isinstance(body, list):
+        return u"Batch must be a non-empty list of requests", INVALID_REQUEST
+    if len(body) > MAX_BATCH_SIZE:
+        return u"Batch accepts at most {} requests, but {} were given".format(MAX_BATCH_SIZE, len(body)), \
+            INVALID_REQUEST
+
+    auth = cached_auth({})
+
+    def execute(item):
+        try:
+            response, code = method_handler({"body": item, "headers": request.get('headers')}, {}, store, auth)
+            if isinstance(response, codec.ObjectStream):
+                response = dict(response)
+        except Exception, e:
+            logging.exception(u"Unexpected error: %s" % e.message)
+            response, code = ERRORS[INTERNAL_ERROR], INTERNAL_ERROR
+        return {"code": code, "response": response}
+
+    if parallel and len(body) > 1:
+        results = get_batch_pool().map(execute, body)
+    else:
+        results = map(execute, body)
+    ctx.update({'nrequests': len(body)})
+    return results, OK
+
+
+def process_request(router, path, data_string, headers, context, store):
+    """
+    Разбирает тело запроса, передаёт его обработчику из router по пути path и формирует ответ.
+    Общая часть для всех HTTP фронтендов. Если процесс уже обрабатывает максимум запросов,
+    запрос сразу отклоняется с кодом 503. Запрос с потоковым ответом (codec.ObjectStream) занимает место
+    среди обрабатываемых, пока фронтенд не прочитает или не закроет поток.
+    :param dict router:
+    :param str path:
+    :param str data_string:
+    :param headers:
+    :param dict context:
+    :param store:
+    :return tuple: HTTP код и словарь ответа
+    """
+    if not admission.enter():
+        return reject_request(SERVICE_UNAVAILABLE, context)
+    streamed = False
+    try:
+        code, r = _process_request(router, path, data_string, headers, context, store)
+        streamed = isinstance(r.get("response"), codec.ObjectStream)
+        if streamed:
+            r["response"].on_close(admission.leave)
+        return code, r
+    finally:
+        if not streamed:
+            admission.leave()
+
+
+def _process_request(router, path, data_string, headers, context, store):
+    response, code = {}, OK
+    request = None
+    route = "unknown"
+    started = time.time()
     try:
-        logging.info(u'Processing request: {}'.format(request))
-        mr = get_parsed_request(request)
-        if mr.method in METHODS:
-            response = METHODS[mr.method](mr, ctx, store)
-            code = OK
-            logging.info(u'Request: {} successfully processed. Result is: {}'.format(request, response))
+        request = codec.loads(data_string)
+    except Exception, e:
+        logging.error(u"Bad request: %s" % e.message)
+        code = BAD_REQUEST
+    observe_stage("parse", started)
+
+    if request:
+        logging.debug("%s: %s %s", path, data_string, context["request_id"])
+        path = path.strip("/")
+        if path in router:
+            route = path
+            try:
+                response, code = router[path]({"body": request, "headers": headers}, context, store)
+            except Exception, e:
+                logging.exception(u"Unexpected error: %s" % e.message)
+                code = INTERNAL_ERROR
         else:
-            raise InvalidRequest(u"Unknown method '{}'".format(mr.method))
+            code = NOT_FOUND
+
+    if code not in ERRORS:
+        r = {"response": response, "code": code}
+    else:
+        r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+    context.update(r)
+    if code == OK:
+        logging.info(u"%s %s %s", context["request_id"], path, code, extra=SAMPLED)
+    else:
+        logging.info(u"%s %s %s %s", context["request_id"], path, code, r["error"])
+    logging.debug(u"%s", context)
+    registry.inc("scoring_requests_total", (("path", route), ("code", code)))
+    return code, r
 
-    except InvalidRequest, error:
-        logging.error(u'{}'.format(error))
-        response, code = error.message, INVALID_REQUEST
-    except Forbidden, error:
-        response, code = error.message, FORBIDDEN
-    except ValidationError, error:
-        response, code = error.message, INVALID_REQUEST
 
-    return response, code
+def reject_request(code, context, message=None):
+    """
+    Формирует ответ с ошибкой для запроса, тело которого не было прочитано
+    :param int code:
+    :param dict context:
+    :param str message: текст ошибки, по умолчанию стандартный для code
+    :return tuple: HTTP код и словарь ответа
+    """
+    r = {"error": message or ERRORS[code], "code": code}
+    context.update(r)
+    logging.info(u"%s %s %s", context["request_id"], code, r["error"])
+    registry.inc("scoring_requests_total", (("path", "unknown"), ("code", code)))
+    return code, r
+
+
+def encode_response(r):
+    """
+    Сериализует ответ в JSON
+    :param dict r:
+    :return list: куски тела ответа, которые записываются в сокет по очереди, либо codec.EncodedStream,
+        который нужно закрыть после отправки
+    """
+    started = time.time()
+    chunks = codec.encode_response(r)
+    observe_stage("serialization", started)
+    return chunks
+
+
+def get_metrics():
+    """
+    Показатели сервиса в текстовом формате Prometheus
+    :return str:
+    """
+    return registry.render()
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler,
+        "batch": batch_handler,
     }
     store = None
 
+    # Постоянные HTTP/1.1 соединения: простаивающее соединение закрывается через timeout секунд,
+    # а после max_requests запросов клиента просят переподключиться. Только для серверов с keep_alive,
+    # см. setup().
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    max_requests = 1000
+    # Заголовки и тело ответа уходят одним пакетом при flush() в конце handle_one_request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # Тела больше max_body_size байт отклоняются до чтения, на чтение тела отводится body_timeout секунд
+    max_body_size = MAX_BODY_SIZE
+    body_timeout = BODY_TIMEOUT
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.idle = False
+        if not getattr(self.server, "keep_alive", False):
+            # Однопоточный сервер, ожидая следующий запрос по открытому соединению, не обслуживал бы
+            # остальных клиентов, поэтому закрывает соединение после каждого ответа
+            self.protocol_version = "HTTP/1.0"
+            self.requests_served = 0
+        else:
+            self.requests_served = self.server.served.pop(self.request, 0)
+
+    def handle(self):
+        """
+        Обрабатывает запросы соединения по очереди. Если следующий запрос ещё не получен, обработчик
+        завершается с idle = True, и сервер ждёт запрос без потока пула (ThreadPoolHTTPServer.park).
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if not has_buffered(self.rfile):
+                self.idle = True
+                return
+            self.handle_one_request()
+
     @staticmethod
     def get_request_id(headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return headers.get('X-Request-Id') or uuid.uuid4().hex
+
+    def read_body(self, length):
+        """
+        Читает тело запроса прямо из сокета в буфер потока. Перед каждым recv_into тайм-аут сокета
+        уменьшается до остатка общего срока, поэтому клиент, присылающий тело по байту, не растянет
+        чтение дольше body_timeout.
+        :param int length:
+        :return str:
+        :raises socket.timeout: если тело не получено за body_timeout секунд
+        """
+        deadline = time.time() + self.body_timeout
+        buf = memoryview(read_buffer(length))
+        # Начало тела могло быть прочитано из сокета вместе с заголовками
+        data = take_buffered(self.rfile, length)
+        received = len(data)
+        buf[:received] = data
+        try:
+            while received < length:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise socket.timeout("body was not received in %s seconds" % self.body_timeout)
+                self.connection.settimeout(min(left, self.timeout))
+                n = self.connection.recv_into(buf[received:length])
+                if not n:
+                    raise ValueError("connection closed after %d of %d bytes" % (received, length))
+                received += n
+        finally:
+            self.connection.settimeout(self.timeout)
+        return buf[:length].tobytes()
 
     def do_POST(self):
-        response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
+        data_string = None
+        code = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            length = int(self.headers['Content-Length'])
+            if length > self.max_body_size:
+                code = REQUEST_ENTITY_TOO_LARGE
+            else:
+                data_string = self.read_body(length)
+        except socket.timeout, e:
+            logging.error(u"Request timeout: %s" % e)
+            code = REQUEST_TIMEOUT
         except Exception, e:
-            logging.error(u"Bad request: %s" % e.message)
-            code = BAD_REQUEST
+            logging.error(u"Bad request: %s" % e)
+        if data_string is None:
+            # Тело не прочитано, поэтому следующий запрос в этом соединении не найти
+            self.close_connection = 1
 
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception, e:
-                    logging.exception(u"Unexpected error: %s" % e.message)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+        if code is None:
+            code, r = process_request(self.router, self.path, data_string, self.headers, context, self.store)
+        else:
+            code, r = reject_request(code, context)
+        chunks = encode_response(r)
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = 1
+
+        if not isinstance(chunks, list):
+            try:
+                self.write_stream(code, chunks)
+            finally:
+                chunks.close()
+            return
 
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(sum(len(chunk) for chunk in chunks)))
+        if code in (TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE):
+            self.send_header("Retry-After", str(RETRY_AFTER))
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
+        # wfile буферизован, поэтому куски не склеиваются в памяти и уходят в сокет одним flush()
+        for chunk in chunks:
+            self.wfile.write(chunk)
         return
 
+    def write_stream(self, code, chunks):
+        """
+        Отправляет ответ заранее неизвестной длины: клиентам HTTP/1.1 с Transfer-Encoding: chunked,
+        остальным - до закрытия соединения
+        """
+        chunked = self.protocol_version == self.request_version == "HTTP/1.1"
+        if not chunked:
+            self.close_connection = 1
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunked:
+                    chunk = "%x\r\n%s\r\n" % (len(chunk), chunk)
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except Exception, e:
+            # Заголовки уже отправлены, поэтому сообщить об ошибке можно только оборвав ответ
+            logging.exception(u"Streaming response failed: %s" % e)
+            self.close_connection = 1
+            return
+        if chunked:
+            self.wfile.write("0\r\n\r\n")
+
+    def log_request(self, code='-', size='-'):
+        extra = SAMPLED if code == OK else None
+        logging.info('%s "%s" %s %s', self.client_address[0], self.requestline, code, size, extra=extra)
+
+    def log_error(self, format, *args):
+        logging.error("%s " + format, self.client_address[0], *args)
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0].strip("/") == "metrics":
+            code, content_type, body = OK, METRICS_CONTENT_TYPE, get_metrics()
+        else:
+            code, content_type = NOT_FOUND, "application/json"
+            body = "".join(codec.encode_response({"error": ERRORS[NOT_FOUND], "code": NOT_FOUND}))
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-if __name__ == "__main__":
+
+def make_option_parser():
+    """
+    Параметры командной строки, общие для всех HTTP фронтендов
+    :return OptionParser:
+    """
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    op.add_option("--snapshot", action="store", default=None, help="score cache snapshot file")
+    op.add_option("--snapshot-interval", action="store", type=int, default=SNAPSHOT_INTERVAL)
+    op.add_option("--log-level", action="store", default="info")
+    op.add_option("--log-queue", action="store", type=int, default=0)
+    op.add_option("--log-sample", action="store", type=float, default=1.0)
+    op.add_option("-t", "--threads", action="store", type=int, default=0)
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("-s", "--store", action="store", default=None)
+    op.add_option("--max-body", action="store", type=int, default=MAX_BODY_SIZE)
+    op.add_option("--body-timeout", action="store", type=float, default=BODY_TIMEOUT)
+    op.add_option("--response-cache-size", action="store", type=int, default=RESPONSE_CACHE_SIZE)
+    op.add_option("--response-cache-ttl", action="store", type=int, default=RESPONSE_CACHE_TTL)
+    op.add_option("--no-response-cache", action="append", default=[], metavar="ACCOUNT",
+                  help="do not cache online_score responses for ACCOUNT, can be repeated")
+    op.add_option("-c", "--catalog", action="store", default=None, help="interest catalog file")
+    op.add_option("--queue-size", action="store", type=int, default=0,
+                  help="requests waiting for a pool thread, others get 503; 0 - unlimited")
+    op.add_option("--max-in-flight", action="store", type=int, default=0,
+                  help="requests processed at once by a worker, others get 503")
+    op.add_option("--rate-limit", action="store", type=float, default=0, help="requests per second per account")
+    op.add_option("--burst", action="store", type=int, default=0, help="token bucket size per account")
+    op.add_option("--account-concurrency", action="store", type=int, default=0,
+                  help="requests processed at once per account")
+    op.add_option("--shared-cache", action="store", type=int, default=0, metavar="SLOTS",
+                  help="score cache slots in shared memory, 0 - disabled")
+    op.add_option("--shared-cache-file", action="store", default=None,
+                  help="file backing the shared memory cache, default - anonymous memory")
+    op.add_option("--profile", action="store_true", default=False, help="start with profiling enabled")
+    op.add_option("--profile-dir", action="store", default="profiles")
+    op.add_option("--profile-rate", action="store", type=float, default=PROFILE_RATE)
+    op.add_option("--profile-id-prefix", action="store", default=PROFILE_ID_PREFIX)
+    return op
+
+
+def configure(opts):
+    """
+    Настраивает логирование, кэши, лимиты, профилирование и каталог интересов по параметрам командной строки
+    :param opts: параметры make_option_parser()
+    :return BaseStore: хранилище для обработчиков
+    """
+    global interest_catalog
+    setup_logging(opts.log, logging.getLevelName(opts.log_level.upper()), opts.log_queue, opts.log_sample)
+    response_cache.configure(opts.response_cache_size, opts.response_cache_ttl, opts.no_response_cache)
+    admission.configure(opts.max_in_flight, opts.rate_limit, opts.burst, opts.account_concurrency)
+    profiler.directory, profiler.rate, profiler.id_prefix = opts.profile_dir, opts.profile_rate, opts.profile_id_prefix
+    if opts.profile:
+        profiler.enable()
+    toggle_on_signal(profiler)
+    if opts.catalog:
+        interest_catalog = InterestCatalog.load(opts.catalog)
+    # Хранилище создаётся до fork(), чтобы кэш в разделяемой памяти был общим для всех процессов
+    store = make_store(opts.store, opts.shared_cache, opts.shared_cache_file)
+    if opts.snapshot:
+        store = SnapshotStore(store, opts.snapshot, opts.snapshot_interval)
+    return store
+
+
+def run(server, opts, store):
+    """
+    Обслуживает запросы в текущем процессе или в opts.workers дочерних процессах до SIGTERM/SIGINT.
+    После остановки сохраняет снимок кэша, если он включён.
+    :param server: HTTPServer или aio.AsyncHTTPServer
+    :param opts: параметры make_option_parser()
+    :param store: хранилище из configure()
+    """
+    on_stop = store.save if isinstance(store, SnapshotStore) else None
+    if opts.workers > 1:
+        serve_forked(server, opts.workers, forward=(signal.SIGUSR1,), on_stop=on_stop)
+    else:
+        serve(server, on_stop)
+
+
+if __name__ == "__main__":
+    (opts, args) = make_option_parser().parse_args()
+    MainHTTPHandler.store = configure(opts)
+    MainHTTPHandler.max_body_size = opts.max_body
+    MainHTTPHandler.body_timeout = opts.body_timeout
+    server = make_server(("localhost", opts.port), MainHTTPHandler, threads=opts.threads, queue_size=opts.queue_size)
     logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    run(server, opts, MainHTTPHandler.store)
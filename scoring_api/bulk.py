@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Пакетный скоринг записей из файла без HTTP.
+
+Каждая входная запись - аргументы метода online_score или clients_interests: строка JSON (формат ndjson)
+или строка CSV с заголовком (формат csv). Записи проверяются теми же моделями, что и в API, пачками
+обрабатываются в пуле процессов, а результаты выводятся построчно в JSON в порядке входных записей
+в том же формате, что и ответы API: {"code": 200, "response": ...} или {"code": ..., "error": ...}.
+"""
+
+import sys
+import csv
+import multiprocessing
+
+from collections import deque
+from optparse import OptionParser
+
+import codec
+from api import OnlineScoreRequest, ClientsInterestsRequest, ERRORS, OK, BAD_REQUEST, INVALID_REQUEST
+from models import ValidationError
+from scoring import get_presence, get_scores, get_interests_many
+from store import make_store
+from logs import setup_logging
+
+
+CHUNK_SIZE = 1000
+# Сколько пачек на процесс может быть в работе одновременно: больше не читаем, пока не выведем готовые
+CHUNKS_PER_WORKER = 2
+CSV_CONVERTERS = {
+    "gender": int,
+    "client_ids": lambda value: [int(cid) for cid in value.split()],
+}
+
+# Хранилище процесса-воркера, создаётся в init_worker
+worker_store = None
+
+
+def init_worker(address):
+    global worker_store
+    worker_store = make_store(address)
+
+
+def parse_csv_row(row):
+    """
+    Переводит строку CSV в словарь аргументов: пустые значения пропускаются, gender и client_ids
+    (id через пробел) приводятся к числам. Значения, которые не удалось привести, отдаются как есть,
+    чтобы ошибку сообщила проверка модели.
+    """
+    arguments = {}
+    for key, value in row.iteritems():
+        if not value:
+            continue
+        convert = CSV_CONVERTERS.get(key)
+        if convert is not None:
+            try:
+                value = convert(value)
+            except ValueError:
+                pass
+        arguments[key] = value
+    return arguments
+
+
+def read_records(stream, fmt):
+    """
+    Читает входные записи. Строки ndjson разбираются уже в воркерах, поэтому отдаются как есть.
+    :param stream: файл
+    :param str fmt: ndjson или csv
+    :return: генератор строк JSON или словарей аргументов
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            yield parse_csv_row(row)
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def iter_chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def error(code, message=None):
+    return {"error": message or ERRORS[code], "code": code}
+
+
+def validate(model, record):
+    """
+    Разбирает и проверяет запись
+    :return tuple: (аргументы, экземпляр модели, None) или (None, None, ответ с ошибкой)
+    """
+    if isinstance(record, basestring):
+        try:
+            record = codec.loads(record)
+        except Exception, e:
+            return None, None, error(BAD_REQUEST, u"Bad record: %s" % e)
+    if not isinstance(record, dict):
+        return None, None, error(INVALID_REQUEST, u"Record must be an object, got {}".format(type(record)))
+    try:
+        request = model(record)
+    except ValidationError, e:
+        return None, None, error(INVALID_REQUEST, e.message)
+    if not request.is_valid():
+        return None, None, error(INVALID_REQUEST, request.errors)
+    return record, request, None
+
+
+def score_online(chunk):
+    """
+    Проверяет пачку записей online_score и считает скоринг всех корректных записей одним вызовом get_scores
+    :param list chunk:
+    :return list: ответы в порядке записей
+    """
+    results, valid, positions = [], [], []
+    for record in chunk:
+        arguments, request, response = validate(OnlineScoreRequest, record)
+        if response is None and not request.validate_arguments():
+            response = error(INVALID_REQUEST, u"Not enough arguments in request: {}".format(arguments))
+        if response is None:
+            positions.append(len(results))
+            valid.append(arguments)
+        results.append(response)
+    if valid:
+        for position, score in zip(positions, get_scores(*get_presence(valid))):
+            results[position] = {"response": {"score": float(score)}, "code": OK}
+    return results
+
+
+def score_interests(chunk):
+    """
+    Проверяет пачку записей clients_interests и получает интересы клиентов из хранилища воркера
+    :param list chunk:
+    :return list: ответы в порядке записей
+    """
+    results = []
+    for record in chunk:
+        _, request, response = validate(ClientsInterestsRequest, record)
+        if response is None:
+            response = {"response": get_interests_many(worker_store, request.client_ids), "code": OK}
+        results.append(response)
+    return results
+
+
+METHODS = {
+    "online_score": score_online,
+    "clients_interests": score_interests,
+}
+
+
+def process_chunk(args):
+    method, chunk = args
+    return [codec.dumps(r) for r in METHODS[method](chunk)]
+
+
+def run(records, method, workers=0, chunk_size=CHUNK_SIZE, store=None):
+    """
+    Обрабатывает записи пачками и отдаёт строки результатов в порядке записей
+    :param records: итерируемая последовательность записей
+    :param str method: online_score или clients_interests
+    :param int workers: число процессов, 0 - обрабатывать в текущем процессе
+    :param int chunk_size: число записей в пачке
+    :param str store: адрес хранилища host:port
+    :return: генератор строк JSON
+    """
+    tasks = ((method, chunk) for chunk in iter_chunks(records, chunk_size))
+    if workers <= 0:
+        init_worker(store)
+        for task in tasks:
+            for line in process_chunk(task):
+                yield line
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(store,))
+    try:
+        # Pool.imap вычитывает все задачи сразу, поэтому число пачек в работе ограничиваем сами
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(process_chunk, (task,)))
+            if len(pending) >= workers * CHUNKS_PER_WORKER:
+                for line in pending.popleft().get():
+                    yield line
+        while pending:
+            for line in pending.popleft().get():
+                yield line
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [input]")
+    op.add_option("-m", "--method", action="store", choices=sorted(METHODS), default="online_score")
+    op.add_option("-f", "--format", action="store", choices=["ndjson", "csv"], default="ndjson")
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=multiprocessing.cpu_count())
+    op.add_option("-c", "--chunk-size", action="store", type=int, default=CHUNK_SIZE)
+    op.add_option("-s", "--store", action="store", default=None)
+    (opts, args) = op.parse_args()
+    setup_logging()
+    source = open(args[0], "rb") if args else sys.stdin
+    output = open(opts.output, "wb") if opts.output else sys.stdout
+    try:
+        for line in run(read_records(source, opts.format), opts.method, opts.workers, opts.chunk_size, opts.store):
+            output.write(line)
+            output.write("\n")
+    finally:
+        output.flush()
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Каталог интересов клиентов.
+
+Интересы клиента хранятся битовой маской uint16 в таблице, индекс в которой - id клиента, поэтому десятки
+миллионов клиентов занимают по два байта. В имена маска превращается только при формировании ответа,
+по заранее построенной таблице списков для всех возможных масок. Для каждого интереса хранится отсортированный
+список id клиентов (обратный индекс), по которому отвечает метод clients_by_interest.
+
+Каталог строится из файла ndjson со строками {"client_id": 1, "interests": ["cars", "pets"]} и сохраняется
+в бинарный файл, который при загрузке отображается в память через mmap и не читается целиком:
+
+    заголовок <4sHHI: магия, версия, число интересов, число клиентов
+    имена интересов: байт длины и имя в utf-8 для каждого интереса
+    длины списков обратного индекса: uint32 для каждого интереса
+    маски клиентов: uint16 для каждого клиента
+    списки обратного индекса: uint32 id клиентов подряд для каждого интереса
+"""
+
+import sys
+import mmap
+import json
+import array
+import struct
+
+from optparse import OptionParser
+
+import codec
+from scoring import INTERESTS, INTERESTS_CHUNK_SIZE
+
+
+MAGIC = "ICAT"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+MAX_INTERESTS = 16
+MASK_TYPE, MASK_SIZE = "H", 2
+ID_TYPE, ID_SIZE = "I", 4
+
+
+def native_array(typecode, data):
+    # В файле числа little-endian, массив в памяти - в порядке байт машины
+    values = array.array(typecode, data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def file_bytes(values):
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+class MappedArray(object):
+    """
+    Массив беззнаковых чисел little-endian внутри буфера (mmap) без копирования в память процесса.
+    Поддерживает len(), индекс и срез; срез возвращает array.array.
+    """
+
+    def __init__(self, buf, offset, length, typecode, itemsize):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.typecode = typecode
+        self.itemsize = itemsize
+        self.item = struct.Struct("<" + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            values = native_array(self.typecode, self.buf[self.offset + start * self.itemsize:
+                                                          self.offset + max(start, stop) * self.itemsize])
+            return values if step == 1 else values[::step]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("MappedArray index out of range")
+        return self.item.unpack_from(self.buf, self.offset + index * self.itemsize)[0]
+
+
+class InterestCatalog(object):
+    """
+    :param list names: имена интересов, номер бита маски - индекс имени
+    :param masks: маски интересов по id клиента (array.array или MappedArray)
+    :param list postings: отсортированные id клиентов для каждого интереса
+    """
+
+    def __init__(self, names, masks, postings):
+        if len(names) > MAX_INTERESTS:
+            raise ValueError("Catalog supports at most %d interests" % MAX_INTERESTS)
+        self.names = list(names)
+        self.bits = {name: i for i, name in enumerate(self.names)}
+        self.masks = masks
+        self.postings = postings
+        # Списки имён для всех масок создаются и кодируются в JSON один раз. Изменять их нельзя.
+        self.decoded = [codec.constant([name for i, name in enumerate(self.names) if mask & (1 << i)])
+                        for mask in xrange(1 << len(self.names))]
+
+    @classmethod
+    def build(cls, pairs, names=INTERESTS):
+        """
+        Строит каталог в памяти
+        :param pairs: итерируемая последовательность пар (id клиента, список интересов)
+        :param list names: известные интересы, остальные пропускаются
+        :return InterestCatalog:
+        """
+        bits = {name: i for i, name in enumerate(names)}
+        masks = array.array(MASK_TYPE)
+        for cid, interests in pairs:
+            if cid < 0:
+                continue
+            if cid >= len(masks):
+                masks.extend([0] * (cid + 1 - len(masks)))
+            mask = 0
+            for name in interests:
+                bit = bits.get(name)
+                if bit is not None:
+                    mask |= 1 << bit
+            masks[cid] = mask
+        postings = [array.array(ID_TYPE) for _ in names]
+        for cid, mask in enumerate(masks):
+            while mask:
+                bit = mask & -mask
+                postings[bit.bit_length() - 1].append(cid)
+                mask ^= bit
+        return cls(names, masks, postings)
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.names), len(self.masks)))
+            for name in self.names:
+                encoded = name.encode("utf-8")
+                f.write(struct.pack("<B", len(encoded)) + encoded)
+            f.write(file_bytes(array.array(ID_TYPE, [len(p) for p in self.postings])))
+            f.write(file_bytes(array.array(MASK_TYPE, self.masks[:])))
+            for posting in self.postings:
+                f.write(file_bytes(array.array(ID_TYPE, posting[:])))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Отображает файл каталога в память. Страницы файла читаются с диска по мере обращения к ним
+        и разделяются всеми процессами, открывшими тот же файл.
+        :return InterestCatalog:
+        """
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ninterests, nclients = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an interest catalog" % filename)
+        offset = HEADER.size
+        names = []
+        for _ in xrange(ninterests):
+            length = ord(buf[offset])
+            names.append(buf[offset + 1:offset + 1 + length].decode("utf-8"))
+            offset += 1 + length
+        lengths = native_array(ID_TYPE, buf[offset:offset + ninterests * ID_SIZE])
+        offset += ninterests * ID_SIZE
+        masks = MappedArray(buf, offset, nclients, MASK_TYPE, MASK_SIZE)
+        offset += nclients * MASK_SIZE
+        postings = []
+        for length in lengths:
+            postings.append(MappedArray(buf, offset, length, ID_TYPE, ID_SIZE))
+            offset += length * ID_SIZE
+        return cls(names, masks, postings)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def get(self, cid):
+        """
+        :return list: интересы клиента, неизвестному клиенту - пустой список
+        """
+        if 0 <= cid < len(self.masks):
+            return self.decoded[self.masks[cid]]
+        return self.decoded[0]
+
+    def iter_many(self, client_ids, chunk_size=INTERESTS_CHUNK_SIZE):
+        """
+        То же, что scoring.iter_interests, но из каталога
+        :return: генератор списков пар (client_id, список интересов)
+        """
+        seen = set()
+        get = self.get
+        for start in xrange(0, len(client_ids), chunk_size):
+            chunk = []
+            for cid in client_ids[start:start + chunk_size]:
+                if cid not in seen:
+                    seen.add(cid)
+                    chunk.append((cid, get(cid)))
+            if chunk:
+                yield chunk
+
+    def get_many(self, client_ids):
+        """
+        :return dict: client_id -> список интересов
+        """
+        get = self.get
+        return {cid: get(cid) for cid in client_ids}
+
+    def count(self, interest):
+        bit = self.bits.get(interest)
+        return 0 if bit is None else len(self.postings[bit])
+
+    def clients(self, interest, offset=0, limit=None):
+        """
+        Id клиентов с интересом interest по возрастанию
+        :param str interest:
+        :param int offset: сколько id пропустить
+        :param int limit: максимум id в ответе
+        :return list:
+        """
+        bit = self.bits.get(interest)
+        if bit is None:
+            return []
+        posting = self.postings[bit]
+        stop = len(posting) if limit is None else min(len(posting), offset + limit)
+        return posting[offset:stop].tolist()
+
+
+def read_pairs(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            record = json.loads(line)
+            yield record["client_id"], record["interests"]
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] output.icat [input.ndjson]")
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error("output file is required")
+    source = open(args[1], "rb") if len(args) > 1 else sys.stdin
+    catalog = InterestCatalog.build(read_pairs(source))
+    catalog.save(args[0])
+    print "%d clients, %s" % (len(catalog), ", ".join("%s: %d" % (name, catalog.count(name))
+                                                     for name in catalog.names))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Кодирование и разбор JSON. Если установлен ujson или simplejson, используется он, иначе стандартный json.
+Ответы сервиса кодируются кусками: готовые префиксы конверта {"code": ..., "response": ...} и заранее
+закодированные неизменяемые ответы не сериализуются заново на каждый запрос.
+"""
+
+import json
+
+try:
+    import ujson as backend
+    BACKEND = "ujson"
+except ImportError:
+    try:
+        import simplejson as backend
+        BACKEND = "simplejson"
+    except ImportError:
+        backend = json
+        BACKEND = "json"
+
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+# id(объект) -> (объект, закодированная строка). Сам объект храним, чтобы его id не достался другому объекту.
+_constants = {}
+_prefixes = {}
+_errors = {}
+
+
+def loads(data):
+    return backend.loads(data)
+
+
+def _dumps(obj):
+    if BACKEND == "ujson":
+        try:
+            return backend.dumps(obj)
+        except (TypeError, OverflowError, ValueError):
+            # ujson не умеет некоторые ключи и типы, которые понимает стандартный json
+            return _encoder.encode(obj)
+    if BACKEND == "simplejson":
+        return backend.dumps(obj, separators=(",", ":"))
+    return _encoder.encode(obj)
+
+
+def dumps(obj):
+    """
+    Кодирует объект в JSON, для объектов зарегистрированных через constant() возвращает готовую строку
+    :return str:
+    """
+    cached = _constants.get(id(obj))
+    if cached is not None and cached[0] is obj:
+        return cached[1]
+    return _dumps(obj)
+
+
+def constant(obj):
+    """
+    Регистрирует неизменяемый ответ: dumps() будет отдавать для него заранее закодированную строку.
+    Объект после регистрации изменять нельзя.
+    :return: тот же объект
+    """
+    _constants[id(obj)] = (obj, _dumps(obj))
+    return obj
+
+
+class ObjectStream(object):
+    """
+    JSON объект, который кодируется по частям по мере получения данных.
+    Ресурсы, занятые на время получения данных, освобождают функции, переданные в on_close(): они вызываются
+    один раз, когда поток прочитан или закрыт.
+    :param chunks: итерируемая последовательность списков пар (ключ, значение)
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.callbacks = []
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                for pair in chunk:
+                    yield pair
+        finally:
+            self.close()
+
+    def on_close(self, callback):
+        self.callbacks.append(callback)
+
+    def close(self):
+        callbacks, self.callbacks = self.callbacks, []
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        for callback in reversed(callbacks):
+            callback()
+
+
+class EncodedStream(object):
+    """
+    Куски JSON потокового ответа. close() нужно вызвать, даже если куски не были прочитаны:
+    он закрывает ObjectStream.
+    """
+
+    def __init__(self, prefix, stream):
+        self.stream = stream
+        self.chunks = _stream(prefix, stream)
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.chunks.close()
+        self.stream.close()
+
+
+def _stream(prefix, stream):
+    yield prefix + "{"
+    separator = ""
+    for pairs in stream.chunks:
+        if pairs:
+            yield separator + ",".join("%s:%s" % (_dumps(unicode(key)), dumps(value)) for key, value in pairs)
+            separator = ","
+    yield "}}"
+
+
+def encode_response(r):
+    """
+    Кодирует конверт ответа {"code": ..., "response": ...} или {"code": ..., "error": ...} в список кусков,
+    которые можно записать в сокет по очереди, не склеивая в одну строку.
+    Если ответ - ObjectStream, возвращается EncodedStream: длина тела заранее неизвестна.
+    :param dict r:
+    :return list:
+    """
+    code = r["code"]
+    if "response" in r:
+        prefix = _prefixes.get(code)
+        if prefix is None:
+            prefix = _prefixes[code] = '{"code":%d,"response":' % code
+        response = r["response"]
+        if isinstance(response, ObjectStream):
+            return EncodedStream(prefix, response)
+        return [prefix, dumps(response), "}"]
+
+    error = r["error"]
+    if isinstance(error, basestring):
+        body = _errors.get((code, error))
+        if body is not None:
+            return [body]
+    return [_dumps(r)]
+
+
+def register_errors(errors):
+    """
+    Заранее кодирует ответы со стандартными текстами ошибок
+    :param dict errors: код -> текст ошибки
+    """
+    for code, text in errors.iteritems():
+        _errors[(code, text)] = _dumps({"error": text, "code": code})
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Неблокирующее логирование: обработчики запросов только кладут записи в ограниченную очередь,
+а форматирование и запись на диск выполняет фоновый поток пачками.
+"""
+
+import os
+import random
+import logging
+import itertools
+import threading
+
+from Queue import Queue, Full, Empty
+
+from metrics import registry
+
+
+LOG_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+LOG_DATEFMT = '%Y.%m.%d %H:%M:%S'
+# extra для записей об успешно обработанных запросах: они попадают в лог с вероятностью sample_rate
+SAMPLED = {"sampled": True}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rate записей, помеченных как sampled. Остальные записи пропускаются всегда.
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """
+    Кладёт записи в очередь не форматируя их. Если очередь заполнена, запись отбрасывается и учитывается
+    в счётчике dropped. Фоновый поток, который пишет записи в target, запускается при первой записи в
+    каждом процессе, поэтому обработчик можно настроить до fork().
+    """
+
+    def __init__(self, target, maxsize=10000, batch_size=256):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.drops = itertools.count()
+        self.dropped = 0
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            # После fork() очередь и поток родителя непригодны: блокировки очереди могли остаться захваченными
+            self.queue = Queue(self.maxsize)
+            self.thread = threading.Thread(target=self.run, name="log-writer")
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            # next() у itertools.count атомарен под GIL, в отличие от += 1
+            self.dropped = next(self.drops) + 1
+
+    def run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            stop = None in batch
+            self.write([record for record in batch if record is not None])
+            if stop:
+                break
+
+    def write(self, records):
+        if not records:
+            return
+        target = self.target
+        stream = getattr(target, "stream", None)
+        if stream is None or type(target) not in (logging.StreamHandler, logging.FileHandler):
+            for record in records:
+                target.handle(record)
+            return
+        lines = []
+        for record in records:
+            if not target.filter(record):
+                continue
+            try:
+                line = target.format(record)
+            except Exception:
+                target.handleError(record)
+                continue
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            lines.append(line)
+        if not lines:
+            return
+        # Одна запись в файл и один flush на всю пачку
+        target.acquire()
+        try:
+            target.stream.write("\n".join(lines) + "\n")
+            target.flush()
+        finally:
+            target.release()
+
+    def close(self):
+        if self.pid == os.getpid() and self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.pid = None
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(filename=None, level=logging.INFO, queue_size=0, sample_rate=1.0):
+    """
+    Настраивает корневой логгер
+    :param str filename: файл лога, по умолчанию stderr
+    :param level: уровень логирования, тела запросов и ответов пишутся только на уровне DEBUG
+    :param int queue_size: размер очереди неблокирующего логирования, 0 - писать синхронно
+    :param float sample_rate: доля записей об успешных запросах, попадающих в лог
+    :return logging.Handler:
+    """
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    handler = target
+    if queue_size > 0:
+        handler = QueueHandler(target, maxsize=queue_size)
+        registry.gauge("scoring_log_dropped_records", "Log records dropped because the log queue was full",
+                       lambda: handler.dropped)
+    if sample_rate < 1.0:
+        handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Потокобезопасный словарь ограниченного размера с вытеснением давно не использованных ключей
+    и необязательным временем жизни записей.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                return default
+            # Переставим ключ в конец, как самый свежий
+            self.data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expires)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def items(self):
+        """
+        :return list: тройки (ключ, значение, момент истечения или None) от давно использованных к свежим
+        """
+        with self.lock:
+            return [(key, value, expires) for key, (value, expires) in self.data.iteritems()]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
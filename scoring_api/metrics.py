@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+Счётчики и гистограммы задержек в формате Prometheus.
+
+Каждый поток пишет в собственный набор счётчиков без блокировок; при запросе /metrics наборы всех
+потоков складываются. Блокировка берётся только при первом обращении нового потока.
+"""
+
+import bisect
+import threading
+
+from collections import defaultdict
+
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Shard(object):
+    """Счётчики одного потока"""
+
+    def __init__(self, nbuckets):
+        self.counters = defaultdict(float)
+        # ключ -> [счётчики по корзинам..., сумма, количество]
+        self.histograms = defaultdict(lambda: [0] * nbuckets + [0.0, 0])
+
+
+class Registry(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.help = {}
+        self.gauges = []
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard(len(self.buckets))
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Увеличивает счётчик
+        :param str name:
+        :param tuple labels: пары (имя метки, значение)
+        :param value:
+        """
+        self.shard().counters[(name, labels)] += value
+
+    def observe(self, name, labels, seconds):
+        """
+        Добавляет значение в гистограмму
+        :param str name:
+        :param tuple labels: пары (имя метки, значение)
+        :param float seconds:
+        """
+        h = self.shard().histograms[(name, labels)]
+        i = bisect.bisect_left(self.buckets, seconds)
+        if i < len(self.buckets):
+            h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+    def gauge(self, name, text, func):
+        """
+        Регистрирует показатель, значение которого вычисляет func() в момент сбора. func возвращает число
+        либо список пар (метки, значение).
+        """
+        self.describe(name, "gauge", text)
+        self.gauges.append((name, func))
+
+    def collect(self):
+        """
+        Складывает счётчики всех потоков
+        :return tuple: словари счётчиков и гистограмм
+        """
+        counters = defaultdict(float)
+        histograms = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # items() копирует словарь целиком под GIL, поэтому поток-владелец может продолжать в него писать
+            for key, value in shard.counters.items():
+                counters[key] += value
+            for key, value in shard.histograms.items():
+                merged = histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(list(value)):
+                    merged[i] += v
+        return counters, histograms
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for k, v in labels) + "}"
+
+    def render(self):
+        """
+        Возвращает все показатели в текстовом формате Prometheus
+        :return str:
+        """
+        counters, histograms = self.collect()
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                described.add(name)
+                kind, text = self.help[name]
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name)
+            lines.append("%s%s %s" % (name, self.format_labels(labels), repr(value)))
+
+        for (name, labels), value in sorted(histograms.items()):
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, value):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, self.format_labels(labels, [("le", repr(bound))]),
+                                                 cumulative))
+            lines.append("%s_bucket%s %d" % (name, self.format_labels(labels, [("le", "+Inf")]), value[-1]))
+            lines.append("%s_sum%s %s" % (name, self.format_labels(labels), repr(value[-2])))
+            lines.append("%s_count%s %d" % (name, self.format_labels(labels), value[-1]))
+
+        for name, func in self.gauges:
+            header(name)
+            value = func()
+            if isinstance(value, (int, long, float)):
+                value = [((), value)]
+            for labels, v in value:
+                lines.append("%s%s %s" % (name, self.format_labels(labels), repr(float(v))))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("scoring_requests_total", "counter", "HTTP requests by path and response code")
+registry.describe("scoring_method_requests_total", "counter", "Method requests by method and response code")
+registry.describe("scoring_stage_seconds", "histogram",
+                  "Time spent in request stages: parse, auth, validation, scoring, serialization")
+registry.describe("scoring_method_seconds", "histogram", "Time spent in method handlers")
+registry.describe("scoring_admission_rejected_total", "counter",
+                  "Requests rejected by admission control by reason: queue, in_flight, rate, concurrency")
+registry.describe("scoring_response_cache_total", "counter", "online_score response cache lookups by result")
+registry.describe("scoring_coalesced_total", "counter",
+                  "Store lookups by result: leader performed the lookup, shared waited for a concurrent one")
@@ -1,8 +1,51 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import datetime
 import abc
+# datetime.strptime импортирует _strptime при первом вызове, и в нескольких потоках сразу этот импорт
+# падает с AttributeError. Импортируем модуль заранее.
+import _strptime  # noqa
+
+
+DATE_FORMAT = "%d.%m.%Y"
+DATE_REGEX = re.compile(r"(\d\d)\.(\d\d)\.(\d{4})\Z")
+DATE_CACHE_SIZE = 4096
+# Строка даты -> datetime.date или None. Заполняется parse_date, при переполнении очищается целиком.
+_date_cache = {}
+
+
+def _parse_date(value):
+    match = DATE_REGEX.match(value)
+    if match is not None:
+        day, month, year = match.groups()
+        try:
+            return datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
+    # Одноразрядные день и месяц strptime тоже принимает
+    try:
+        return datetime.datetime.strptime(value, DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+def parse_date(value):
+    """
+    Разбирает дату в формате dd.mm.yyyy. Результаты для недавно встречавшихся строк запоминаются.
+    :param basestring value:
+    :return datetime.date: дата или None, если строка не является датой
+    """
+    try:
+        return _date_cache[value]
+    except KeyError:
+        pass
+    date = _parse_date(value)
+    if len(_date_cache) >= DATE_CACHE_SIZE:
+        _date_cache.clear()
+    _date_cache[value] = date
+    return date
 
 
 class ValidationError(ValueError):
@@ -17,42 +60,78 @@ class Forbidden(ValueError):
     pass
 
 
+class TooManyRequests(ValueError):
+    pass
+
+
 class Field(object):
     """Базовый класс определяющий поле. От него наследуются все другие поля."""
     __metaclass__ = abc.ABCMeta
 
     pattern = None
     basetype = basestring
-    blank_value = ['', (), [], {}, None]
+    blank_types = (basestring, tuple, list, dict)
+    # Если задан, модель хранит результат parse(value) в атрибуте <имя поля><parsed_suffix>
+    parsed_suffix = None
 
     def __init__(self, required=False, nullable=False):
         self.required = required
         self.nullable = nullable
 
         self.name = None
+        self.regex = None
+        # Дескриптор слота, в котором компактная модель хранит значение поля
+        self.slot = None
+        # ParsedValue для разобранного значения, если у поля есть parsed_suffix
+        self.parsed = None
+
+    def compile(self):
+        """Компилирует регулярное выражение поля. ModelMeta вызывает его один раз при создании модели."""
+        if self.pattern is not None and self.regex is None:
+            self.regex = re.compile(self.pattern)
+
+    def is_blank(self, value):
+        # Пустыми считаются None и пустые строки, кортежи, списки и словари
+        return value is None or (isinstance(value, self.blank_types) and not value)
+
+    def clean(self, value):
+        """
+        Проверяет значение поля и возвращает его, при ошибке делает raise ValidationError
+        """
+        if value is None and self.required is True:
+            raise ValidationError(u'Field {} are required, but value is None'.format(self.name))
+
+        if not self.nullable and self.is_blank(value):
+            raise ValidationError(u'Field {} are not nullable, but value is None'.format(self.name))
+
+        if value is not None:
+            if not isinstance(value, self.basetype):
+                raise ValidationError(
+                    u'Field {} must have {} type but value {} has type {}'.format(self.name, self.basetype, value,
+                                                                                  type(value).__name__))
+            if not self.check_value(value):
+                raise ValidationError(
+                    u'Field {} are not compatible by pattern {} with value "{}"'.format(self.name,
+                                                                                        self.pattern, value))
+        return value
+
+    def store(self, instance, value):
+        if self.slot is not None:
+            self.slot.__set__(instance, value)
+        else:
+            instance.__dict__[self.name] = value
 
     def __set__(self, instance, value):
         if instance:
-            if value is None and self.required is True:
-                raise ValidationError(u'Field {} are required, but value is None'.format(self.name))
-
-            if value in self.blank_value and not self.nullable:
-                raise ValidationError(u'Field {} are not nullable, but value is None'.format(self.name))
-
-            if value is not None:
-                if not isinstance(value, self.basetype):
-                    raise ValidationError(
-                        u'Field {} must have {} type but value {} has type {}'.format(self.name, self.basetype, value,
-                                                                                      type(value).__name__))
-                if not self.check_value(value):
-                    raise ValidationError(
-                        u'Field {} are not compatible by pattern {} with value "{}"'.format(self.name,
-                                                                                            self.pattern, value))
-            # Если мы дошли до сюда, то успешно прошли все проверки.
-            instance.__dict__[self.name] = value
+            self.store(instance, self.clean(value))
 
     def __get__(self, instance, owner):
         if instance:
+            if self.slot is not None:
+                try:
+                    return self.slot.__get__(instance, owner)
+                except AttributeError:
+                    return None
             return instance.__dict__.get(self.name, None)
         else:
             return self
@@ -64,7 +143,9 @@ class Field(object):
             # проверка нужна для типов int, float итп
             if not isinstance(value, basestring):
                 value = str(value)
-            return re.match(self.pattern, value)
+            if self.regex is None:
+                self.compile()
+            return self.regex.match(value)
 
     def check_nullable(self, value):
         if self.nullable and not isinstance(value, int) and (
@@ -112,20 +193,31 @@ class PhoneField(Field):
 
 
 class DateField(Field):
+    """
+    Дата в формате dd.mm.yyyy. Значение поля остаётся строкой, а разобранная datetime.date доступна
+    в атрибуте модели <имя поля>_date.
+    """
+    parsed_suffix = "_date"
+
     def __init__(self, required=False, nullable=False):
         super(DateField, self).__init__(required, nullable)
-        self.pattern = "%d.%m.%Y"
+        self.pattern = DATE_FORMAT
+
+    def compile(self):
+        # pattern здесь - формат даты для strptime, а не регулярное выражение
+        pass
+
+    def parse(self, value):
+        return parse_date(value) if value else None
 
     def __set__(self, instance, value):
-        super(DateField, self).__set__(instance, value)
+        value = self.clean(value)
+        self.store(instance, value)
+        self.parsed.store(instance, self.parse(value))
 
     def check_value(self, value):
         if isinstance(value, self.basetype):
-            try:
-                converted_date = datetime.datetime.strptime(value, self.pattern)
-            except ValueError:
-                return False
-            return converted_date
+            return parse_date(value) or False
         return False
 
 
@@ -133,12 +225,25 @@ class BirthDayField(DateField):
     def __init__(self, required=False, nullable=False):
         super(BirthDayField, self).__init__(required, nullable)
         self.max_age = 70
+        # (момент, до которого действует граница, самая ранняя допустимая дата рождения)
+        self.cutoff = (0, None)
+
+    def get_cutoff(self):
+        """
+        Самая ранняя допустимая дата рождения. Вычисляется заново только после полуночи.
+        """
+        expires, cutoff = self.cutoff
+        if time.time() >= expires:
+            today = datetime.date.today()
+            cutoff = today - datetime.timedelta(days=self.max_age * 365)
+            tomorrow = today + datetime.timedelta(days=1)
+            self.cutoff = (time.mktime(tomorrow.timetuple()), cutoff)
+        return cutoff
 
     def check_value(self, value):
         converted_date = super(BirthDayField, self).check_value(value)
         if converted_date and value:
-            delta = datetime.datetime.today() - converted_date
-            if delta.days < self.max_age * 365:
+            if converted_date > self.get_cutoff():
                 return True
 
 
@@ -152,12 +257,33 @@ class GenderField(Field):
         return super(GenderField, self).check_value(value)
 
 
+class IntegerField(Field):
+    def __init__(self, required=False, nullable=False, min_value=None, max_value=None):
+        super(IntegerField, self).__init__(required, nullable)
+        self.basetype = (int, long)
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def check_value(self, value):
+        if isinstance(value, bool):
+            return False
+        if self.min_value is not None and value < self.min_value:
+            return False
+        if self.max_value is not None and value > self.max_value:
+            return False
+        return True
+
+
 class ClientIDsField(Field):
-    def __init__(self, required=False, nullable=False):
+    def __init__(self, required=False, nullable=False, max_length=None):
         super(ClientIDsField, self).__init__(required, nullable)
         self.basetype = list
+        self.max_length = max_length
 
     def check_value(self, value):
+        if self.max_length is not None and len(value) > self.max_length:
+            raise ValidationError(
+                u'Field {} accepts at most {} values, but {} were given'.format(self.name, self.max_length, len(value)))
         if isinstance(value, self.basetype) and len(value) > 0:
             for i in value:
                 if not isinstance(i, int):
@@ -165,17 +291,78 @@ class ClientIDsField(Field):
             return True
 
 
+SLOT_PREFIX = "_value_"
+
+
+class ParsedValue(object):
+    """
+    Атрибут модели только для чтения с разобранным значением поля, например датой DateField
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.slot = None
+
+    def store(self, instance, value):
+        if self.slot is not None:
+            self.slot.__set__(instance, value)
+        else:
+            instance.__dict__[self.name] = value
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.slot is not None:
+            try:
+                return self.slot.__get__(instance, owner)
+            except AttributeError:
+                return None
+        return instance.__dict__.get(self.name, None)
+
+
 class ModelMeta(type):
-    """Метакласс позволит нам добавить имена полей Field внутрь объектов"""
+    """
+    Метакласс позволит нам добавить имена полей Field внутрь объектов и один раз при создании класса
+    подготовить всё, что нужно для проверки словаря аргументов: словарь полей, набор обязательных полей
+    и скомпилированные регулярные выражения.
+    Для моделей с compact = True значения полей хранятся в __slots__ вместо __dict__ экземпляра.
+    """
 
     def __new__(mcls, name, bases, attrs):
-        declared_fields = list()
-        for attrname, attrvalue in attrs.iteritems():
+        fields, own_fields = {}, []
+        # Имя атрибута -> Field или ParsedValue, для всех значений, которые validate() складывает в values
+        descriptors = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, "fields", {}))
+            descriptors.update(getattr(base, "descriptors", {}))
+        for attrname, attrvalue in attrs.items():
             if isinstance(attrvalue, Field):
                 attrvalue.name = attrname
-                declared_fields.append(attrname)
-        attrs["declared_fields"] = declared_fields
-        return super(ModelMeta, mcls).__new__(mcls, name, bases, attrs)
+                attrvalue.compile()
+                fields[attrname] = attrvalue
+                descriptors[attrname] = attrvalue
+                own_fields.append(attrname)
+                if attrvalue.parsed_suffix is not None:
+                    parsed = attrvalue.parsed = ParsedValue(attrname + attrvalue.parsed_suffix)
+                    attrs[parsed.name] = descriptors[parsed.name] = parsed
+                    own_fields.append(parsed.name)
+        attrs["fields"] = fields
+        attrs["descriptors"] = descriptors
+        attrs["declared_fields"] = list(fields)
+        attrs["required_fields"] = frozenset(key for key, field in fields.iteritems() if field.required)
+
+        base_compact = any(getattr(base, "compact", False) for base in bases)
+        if attrs.get("compact", base_compact) and "__slots__" not in attrs:
+            slots = [SLOT_PREFIX + attrname for attrname in own_fields]
+            if not base_compact:
+                slots.append("errors")
+            attrs["__slots__"] = tuple(slots)
+
+        cls = super(ModelMeta, mcls).__new__(mcls, name, bases, attrs)
+        if cls.compact:
+            for attrname in own_fields:
+                descriptors[attrname].slot = cls.__dict__[SLOT_PREFIX + attrname]
+        return cls
 
 
 class Model(object):
@@ -183,28 +370,22 @@ class Model(object):
     Базовый класс для моделей. Для создания принимает на вход объект-словарь.
     """
     __metaclass__ = ModelMeta
+    __slots__ = ()
+    compact = False
 
     def __init__(self, arguments=None):
         cls = self.__class__
 
-        # Если задан аргумент при создании объекта, то будем использовать свою магию для проверки полей.
+        # Если задан аргумент при создании объекта, то проверим весь словарь за один проход по нему.
         if arguments and isinstance(arguments, dict):
-            self.errors = {}
-
-            # Зададим значения полей в нашем объекте, которые указаны в arguments и совпадают с полями класса.
-            for key, value in arguments.iteritems():
-                if key in self.declared_fields:
-                    try:
-                        setattr(self, key, value)
-                    except ValidationError, error:
-                        self.errors[key] = error.message
-                else:
-                    self.errors[key] = u"Field with name {} are not declared in this object".format(key)
-
-            for unused_field in set(cls.declared_fields) - set(arguments.keys()):
-                # Если остальные поля не указаны, но нужны, то запишем ошибку аналогичную ошибкам ValidationError
-                if getattr(cls, unused_field).required:
-                    self.errors[unused_field] = u'Field {} are required, but value is None'.format(unused_field)
+            if cls.compact:
+                values = {}
+                self.errors = self.validate(arguments, values)
+                descriptors = cls.descriptors
+                for key, value in values.iteritems():
+                    descriptors[key].slot.__set__(self, value)
+            else:
+                self.errors = self.validate(arguments, self.__dict__)
         # Если не задан, то ничего не будем предпринимать
         elif arguments is None:
             pass
@@ -212,6 +393,35 @@ class Model(object):
             raise ValidationError(
                 u"Arguments for {} must have a dict type. We have '{}'".format(cls.__name__, type(arguments)))
 
+    @classmethod
+    def validate(cls, arguments, values):
+        """
+        Проверяет словарь arguments по полям модели и складывает проверенные значения в values
+        :param dict arguments:
+        :param dict values:
+        :return dict: ошибки проверки по именам полей
+        """
+        fields = cls.fields
+        errors = {}
+        for key, value in arguments.iteritems():
+            field = fields.get(key)
+            if field is None:
+                errors[key] = u"Field with name {} are not declared in this object".format(key)
+                continue
+            try:
+                values[key] = value = field.clean(value)
+            except ValidationError, error:
+                errors[key] = error.message
+                continue
+            if field.parsed is not None:
+                values[field.parsed.name] = field.parse(value)
+
+        # Если остальные поля не указаны, но нужны, то запишем ошибку аналогичную ошибкам ValidationError
+        for unused_field in cls.required_fields:
+            if unused_field not in arguments:
+                errors[unused_field] = u'Field {} are required, but value is None'.format(unused_field)
+        return errors
+
     def is_valid(self):
         if hasattr(self, "errors"):
             return len(self.errors) == 0
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Выборочное профилирование обработчиков методов в работающем сервере.
+
+Когда профилирование включено, cProfile запускается для доли rate запросов и для всех запросов, X-Request-Id
+которых начинается с id_prefix. Статистика копится отдельно по каждому методу и записывается в каталог
+directory файлами <метод>.<pid>.pstats, которые можно открыть модулем pstats или snakeviz.
+"""
+
+import os
+import random
+import signal
+import logging
+import threading
+import cProfile
+import pstats
+
+
+PROFILE_RATE = 0.01
+PROFILE_ID_PREFIX = "profile-"
+
+
+class Profiler(object):
+    """
+    :param str directory: каталог для файлов статистики
+    :param float rate: доля профилируемых запросов
+    :param str id_prefix: запросы с таким префиксом X-Request-Id профилируются всегда
+    """
+
+    def __init__(self, directory=None, rate=PROFILE_RATE, id_prefix=PROFILE_ID_PREFIX):
+        self.directory = directory
+        self.rate = rate
+        self.id_prefix = id_prefix
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.calls = {}
+
+    def sample(self, request_id=None):
+        """
+        :return bool: нужно ли профилировать запрос
+        """
+        if not self.enabled:
+            return False
+        if self.id_prefix and request_id and request_id.startswith(self.id_prefix):
+            return True
+        return random.random() < self.rate
+
+    def start(self, request_id=None):
+        """
+        Запускает профилирование текущего потока, если запрос попал в выборку
+        :return: cProfile.Profile, который нужно передать в stop(), или None
+        """
+        if not self.sample(request_id):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, method):
+        """
+        Останавливает профилирование и добавляет результат к статистике метода
+        """
+        profile.disable()
+        with self.lock:
+            stats = self.stats.get(method)
+            if stats is None:
+                self.stats[method] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def enable(self):
+        self.enabled = True
+        logging.info("Profiling enabled, rate %s" % self.rate)
+
+    def disable(self):
+        """
+        Выключает профилирование и записывает накопленную статистику
+        """
+        self.enabled = False
+        logging.info("Profiling disabled")
+        return self.dump()
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def dump(self):
+        """
+        Записывает статистику по методам в directory и очищает её
+        :return list: имена записанных файлов
+        """
+        with self.lock:
+            stats, self.stats, self.calls = self.stats, {}, {}
+        if not self.directory:
+            return []
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filenames = []
+        for method, s in sorted(stats.iteritems()):
+            filename = os.path.join(self.directory, "%s.%s.pstats" % (method, os.getpid()))
+            if os.path.exists(filename):
+                # Статистика с прошлого включения не теряется, а складывается с новой
+                s.add(filename)
+            s.dump_stats(filename)
+            filenames.append(filename)
+        logging.info("Profile statistics written: %s" % ", ".join(filenames))
+        return filenames
+
+    def status(self):
+        with self.lock:
+            calls = dict(self.calls)
+        return {"enabled": self.enabled, "rate": self.rate, "directory": self.directory, "calls": calls}
+
+
+profiler = Profiler()
+
+
+def toggle_on_signal(profiler, signum=signal.SIGUSR1):
+    """
+    Переключает профилирование по сигналу. Запись статистики выполняется в отдельном потоке,
+    чтобы обработчик сигнала не ждал блокировку, которую мог удерживать прерванный им поток.
+    """
+    def handler(signum, frame):
+        threading.Thread(target=profiler.toggle).start()
+
+    signal.signal(signum, handler)
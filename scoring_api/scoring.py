@@ -1,22 +1,161 @@
 # -*- coding: utf-8 -*-
 
 
+import json
 import random
+import hashlib
+
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SCORE_TTL = 60 * 60
+INTERESTS_CHUNK_SIZE = 500
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+# Вес каждого признака в скоринге: есть телефон, есть email, есть дата рождения и пол, есть имя и фамилия
+PHONE_WEIGHT = 1.5
+EMAIL_WEIGHT = 1.5
+BIRTHDAY_GENDER_WEIGHT = 1.5
+NAME_WEIGHT = 0.5
+
+
+def get_score_key(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    parts = [phone, email, birthday, gender, first_name, last_name]
+    key = u"|".join(u"" if part is None else unicode(part) for part in parts)
+    return "uid:" + hashlib.md5(key.encode("utf-8")).hexdigest()
 
 
 def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = None
+    if store is not None:
+        key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+        cached = store.cache_get(key)
+        if cached is not None:
+            return float(cached)
+
+    score = compute_score(phone, email, birthday and gender, first_name and last_name)
+
+    if key is not None:
+        store.cache_set(key, score, SCORE_TTL)
+    return score
+
+
+def compute_score(has_phone, has_email, has_birthday_gender, has_name):
+    """
+    Скоринг одного клиента по признакам наличия данных
+    :return float:
+    """
     score = 0
-    if phone:
-        score += 1.5
-    if email:
-        score += 1.5
-    if birthday and gender:
-        score += 1.5
-    if first_name and last_name:
-        score += 0.5
+    if has_phone:
+        score += PHONE_WEIGHT
+    if has_email:
+        score += EMAIL_WEIGHT
+    if has_birthday_gender:
+        score += BIRTHDAY_GENDER_WEIGHT
+    if has_name:
+        score += NAME_WEIGHT
     return score
 
 
+def get_presence(records):
+    """
+    Переводит записи с полями phone, email, birthday, gender, first_name, last_name в столбцы признаков для get_scores
+    :param records: итерируемая последовательность словарей
+    :return tuple: четыре списка bool одинаковой длины
+    """
+    phones, emails, birthdays_genders, names = [], [], [], []
+    for r in records:
+        get = r.get
+        phones.append(bool(get("phone")))
+        emails.append(bool(get("email")))
+        birthdays_genders.append(bool(get("birthday") and get("gender")))
+        names.append(bool(get("first_name") and get("last_name")))
+    return phones, emails, birthdays_genders, names
+
+
+def get_scores(has_phone, has_email, has_birthday_gender, has_name):
+    """
+    Скоринг пачки клиентов по столбцам признаков. Если установлен numpy, считается векторно и возвращается
+    numpy.ndarray, иначе список float. Результат совпадает с compute_score для каждой строки.
+    :param has_phone: последовательность признаков наличия телефона
+    :param has_email: последовательность признаков наличия email
+    :param has_birthday_gender: последовательность признаков наличия даты рождения и пола
+    :param has_name: последовательность признаков наличия имени и фамилии
+    """
+    columns = (has_phone, has_email, has_birthday_gender, has_name)
+    if len(set(len(c) for c in columns)) > 1:
+        raise ValueError("Score columns must have the same length")
+    if numpy is not None:
+        columns = [numpy.asarray(c, dtype=bool) for c in columns]
+        scores = numpy.zeros(len(columns[0]))
+        for column, weight in izip(columns, (PHONE_WEIGHT, EMAIL_WEIGHT, BIRTHDAY_GENDER_WEIGHT, NAME_WEIGHT)):
+            scores[column] += weight
+        return scores
+    return [compute_score(*flags) for flags in izip(*columns)]
+
+
+def has_interests(store):
+    # Без хранилища или с пустым хранилищем процесса отдаём заглушку, чтобы сервисом можно было пользоваться
+    # автономно, без -s
+    return store is not None and store.has_data
+
+
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    if not has_interests(store):
+        return random.sample(INTERESTS, 2)
+    r = store.get("i:%s" % cid)
+    return json.loads(r) if r else []
+
+
+def fetch_interests(store, client_ids):
+    """
+    Получает интересы пачки клиентов за одно обращение к хранилищу
+    :param store:
+    :param list client_ids: id без повторов
+    :return dict: client_id -> список интересов
+    """
+    if not has_interests(store):
+        return {cid: get_interests(None, cid) for cid in client_ids}
+    values = store.get_many(["i:%s" % cid for cid in client_ids])
+    return {cid: json.loads(r) if r else [] for cid, r in zip(client_ids, values)}
+
+
+def iter_interests(store, client_ids, chunk_size=INTERESTS_CHUNK_SIZE, fetch=fetch_interests):
+    """
+    Получает интересы клиентов пачками по chunk_size ключей за одно обращение к хранилищу и отдаёт
+    их по мере получения, не накапливая весь результат в памяти. Повторяющиеся id пропускаются.
+    :param store:
+    :param list client_ids:
+    :param int chunk_size:
+    :param fetch: функция получения пачки с сигнатурой fetch_interests
+    :return: генератор списков пар (client_id, список интересов), по одному списку на пачку
+    """
+    seen = set()
+    for start in xrange(0, len(client_ids), chunk_size):
+        chunk = []
+        for cid in client_ids[start:start + chunk_size]:
+            if cid not in seen:
+                seen.add(cid)
+                chunk.append(cid)
+        if not chunk:
+            continue
+        interests = fetch(store, chunk)
+        yield [(cid, interests[cid]) for cid in chunk]
+
+
+def get_interests_many(store, client_ids, chunk_size=INTERESTS_CHUNK_SIZE):
+    """
+    Получает интересы для списка клиентов пачками по chunk_size ключей за одно обращение к хранилищу
+    :param store:
+    :param list client_ids:
+    :param int chunk_size:
+    :return dict: client_id -> список интересов
+    """
+    interests = {}
+    for chunk in iter_interests(store, client_ids, chunk_size):
+        interests.update(chunk)
+    return interests
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+
+from Queue import Queue, Full
+from collections import deque
+from BaseHTTPServer import HTTPServer
+
+from metrics import registry
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP сервер, который обрабатывает принятые соединения пулом из заранее запущенных потоков.
+    Главный поток только принимает соединения и складывает их в очередь, поэтому медленный клиент
+    занимает один поток пула, а не весь сервер. Если очередь ограничена queue_size и заполнена,
+    соединение сразу получает ответ 503, а не ждёт свободный поток неограниченно долго.
+
+    Соединение держится открытым между запросами, но поток пула занимает только на время запроса: обработчик
+    возвращает простаивающее соединение через park(), отдельный поток ждёт на нём следующий запрос через poll
+    и ставит соединение в очередь пула, когда из него можно читать. Соединение, простоявшее дольше timeout
+    обработчика, закрывается.
+    """
+    daemon_threads = True
+    keep_alive = True
+    # Как часто проверять, не истёк ли срок простаивающих соединений, в секундах
+    idle_check_interval = 1
+    overload_response = "HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\n" \
+                        "Connection: close\r\n\r\n"
+
+    def __init__(self, server_address, handler_class, threads=4, queue_size=0, bind_and_activate=True):
+        HTTPServer.__init__(self, server_address, handler_class, bind_and_activate)
+        self.threads = threads
+        self.requests = Queue(queue_size)
+        self.workers = []
+        # Соединения, переданные park() потоком пула, и число запросов, уже обслуженных в каждом соединении
+        self.parked = deque()
+        self.served = {}
+        self.watcher = None
+        self.wakeup = None
+        self.stopping = False
+
+    def start_workers(self):
+        # Потоки запускаем не в __init__, а непосредственно перед обслуживанием: после fork() в дочернем
+        # процессе остаётся только вызвавший его поток, поэтому пул должен создаваться уже в воркере.
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target=self.process_request_worker, name="http-worker-%s" % len(self.workers))
+            worker.daemon = self.daemon_threads
+            worker.start()
+            self.workers.append(worker)
+        if self.watcher is None:
+            self.stopping = False
+            self.wakeup = os.pipe()
+            self.watcher = threading.Thread(target=self.watch_idle, name="http-idle")
+            self.watcher.daemon = self.daemon_threads
+            self.watcher.start()
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Full:
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        registry.inc("scoring_admission_rejected_total", (("reason", "queue"),))
+        try:
+            request.sendall(self.overload_response)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if getattr(handler, "idle", False):
+                    self.park(request, client_address, handler.requests_served)
+                else:
+                    self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def park(self, request, client_address, served):
+        """
+        Принимает от потока пула соединение, которое ждёт следующего запроса
+        :param int served: сколько запросов уже обслужено в соединении
+        """
+        if self.stopping:
+            self.shutdown_request(request)
+            return
+        self.parked.append((request, client_address, served))
+        os.write(self.wakeup[1], "x")
+
+    def watch_idle(self):
+        poller = select.poll()
+        poller.register(self.wakeup[0], select.POLLIN)
+        idle = {}
+        while not self.stopping:
+            for fd, _ in poller.poll(self.idle_check_interval * 1000):
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                    continue
+                request, client_address, _ = idle.pop(fd)
+                poller.unregister(fd)
+                self.process_request(request, client_address)
+            while self.parked:
+                request, client_address, served = self.parked.popleft()
+                self.served[request] = served
+                idle[request.fileno()] = (request, client_address, time.time())
+                poller.register(request, select.POLLIN)
+            timeout = self.RequestHandlerClass.timeout
+            if timeout:
+                expired = time.time() - timeout
+                for fd, (request, _, parked) in idle.items():
+                    if parked < expired:
+                        del idle[fd]
+                        poller.unregister(fd)
+                        self.shutdown_request(request)
+        for request, _, _ in idle.values():
+            self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        self.served.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def drain(self):
+        """
+        Закрывает простаивающие соединения, дожидается обработки всех уже принятых запросов и останавливает
+        потоки пула.
+        """
+        if self.watcher is not None:
+            self.stopping = True
+            os.write(self.wakeup[1], "x")
+            self.watcher.join()
+            self.watcher = None
+            for fd in self.wakeup:
+                os.close(fd)
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        # Соединения, которые потоки пула вернули, пока останавливался поток простаивающих соединений
+        while self.parked:
+            self.shutdown_request(self.parked.popleft()[0])
+
+    def server_close(self):
+        self.drain()
+        HTTPServer.server_close(self)
+
+
+def make_server(address, handler_class, threads=0, queue_size=0):
+    """
+    Создаёт сервер: при threads > 0 с пулом потоков, иначе обычный однопоточный HTTPServer
+    :param tuple address:
+    :param handler_class:
+    :param int threads:
+    :param int queue_size: сколько принятых соединений может ждать свободный поток, 0 - без ограничения
+    :return HTTPServer:
+    """
+    if threads > 0:
+        return ThreadPoolHTTPServer(address, handler_class, threads=threads, queue_size=queue_size)
+    return HTTPServer(address, handler_class)
+
+
+def stop_on_signals(server, signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Устанавливает обработчики сигналов, которые корректно завершают serve_forever.
+    shutdown() блокируется до выхода из serve_forever, поэтому вызывать его нужно из другого потока.
+    """
+    def handler(signum, frame):
+        logging.info("Received signal %s, shutting down" % signum)
+        threading.Thread(target=server.shutdown).start()
+
+    for signum in signals:
+        signal.signal(signum, handler)
+
+
+def serve(server, on_stop=None):
+    """
+    Обслуживает запросы до получения SIGTERM/SIGINT, после чего дожидается завершения принятых запросов
+    :param HTTPServer server:
+    :param on_stop: функция, которая вызывается после остановки сервера
+    """
+    stop_on_signals(server)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if on_stop is not None:
+            on_stop()
+
+
+def serve_forked(server, workers, forward=(), on_stop=None):
+    """
+    Запускает workers дочерних процессов, которые обслуживают общий слушающий сокет server.
+    Родительский процесс только следит за детьми и пересылает им сигнал завершения.
+    :param HTTPServer server:
+    :param int workers:
+    :param tuple forward: сигналы, которые родитель пересылает детям как есть
+    :param on_stop: функция, которую вызывает каждый дочерний процесс после остановки сервера
+    """
+    # Сокет неблокирующий: select будит все процессы, но соединение достанется только одному,
+    # остальные получат EAGAIN в accept и вернутся к ожиданию, а не зависнут в нём.
+    server.socket.setblocking(0)
+
+    children = set()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve(server, on_stop)
+            except Exception:
+                logging.exception("Worker %s failed" % os.getpid())
+                code = 1
+            finally:
+                # os._exit не вызывает atexit, поэтому дописываем очередь логов явно
+                logging.shutdown()
+                os._exit(code)
+        children.add(pid)
+    logging.info("Started workers: %s" % sorted(children))
+
+    def send(signum):
+        for child in children:
+            try:
+                os.kill(child, signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: send(signal.SIGTERM))
+    signal.signal(signal.SIGINT, lambda signum, frame: send(signal.SIGTERM))
+    for signum in forward:
+        signal.signal(signum, lambda signum, frame: send(signum))
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        children.discard(pid)
+    server.socket.close()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Объединение одновременных одинаковых обращений к хранилищу (single flight).
+
+Первый поток, запросивший ключ, выполняет обращение сам, а потоки, запросившие тот же ключ, пока оно
+не завершилось, ждут и получают его результат или исключение. Так популярные ключи не порождают лавину
+одинаковых чтений из хранилища. Обработчики в обоих серверах выполняются в потоках, поэтому объединение
+работает и в многопоточном, и в асинхронном режиме.
+"""
+
+import sys
+import threading
+
+from metrics import registry
+
+
+class Call(object):
+    """Выполняющееся обращение по одному ключу"""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class SingleFlight(object):
+    """
+    :param str name: имя обращения в метрике scoring_coalesced_total
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, result, value):
+        if value:
+            registry.inc("scoring_coalesced_total", (("lookup", self.name), ("result", result)), value)
+
+    def do(self, key, func, *args):
+        """
+        Вызывает func(*args), если для key нет выполняющегося вызова, иначе дожидается его результата
+        :return: результат func
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            self.count("shared", 1)
+            return call.wait()
+        self.count("leader", 1)
+        try:
+            call.value = func(*args)
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            self.finish([(key, call)])
+        return call.value
+
+    def do_many(self, keys, func):
+        """
+        Получает значения для списка ключей: ключи, которые уже кто-то получает, ждёт, а остальные
+        получает одним вызовом func
+        :param keys: итерируемая последовательность ключей
+        :param func: функция от списка ключей, возвращающая словарь ключ -> значение
+        :return dict: ключ -> значение
+        """
+        own, waiting, seen = [], [], set()
+        with self.lock:
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                call = self.calls.get(key)
+                if call is None:
+                    call = self.calls[key] = Call()
+                    own.append((key, call))
+                else:
+                    waiting.append((key, call))
+        self.count("leader", len(own))
+        self.count("shared", len(waiting))
+        results = {}
+        if own:
+            # Свои ключи получаем до ожидания чужих, иначе два запроса могли бы ждать друг друга
+            try:
+                results = func([key for key, _ in own])
+                for key, call in own:
+                    call.value = results.get(key)
+            except Exception:
+                error = sys.exc_info()
+                for _, call in own:
+                    call.error = error
+                raise
+            finally:
+                self.finish(own)
+        for key, call in waiting:
+            results[key] = call.wait()
+        return results
+
+    def finish(self, calls):
+        with self.lock:
+            for key, _ in calls:
+                del self.calls[key]
+        for _, call in calls:
+            call.event.set()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Снимки кэша скоринга на диске для быстрого старта после перезапуска.
+
+Снимок - бинарный файл, который при старте отображается в память через mmap и не читается целиком,
+поэтому сервер начинает принимать запросы сразу, а записи подгружаются с диска по мере обращения к ним:
+
+    заголовок <8sI: магия, число записей
+    индекс: <QdII для каждой записи - хэш ключа, момент истечения, смещение и длина значения,
+            записи отсортированы по хэшу для двоичного поиска
+    значения подряд
+
+Ключи хранятся хэшами store.key_hash, как и в кэше в разделяемой памяти, из которого исходные ключи
+не восстановить. Момент истечения - абсолютное время, поэтому срок жизни записи не продлевается перезапуском.
+"""
+
+import os
+import mmap
+import time
+import fcntl
+import heapq
+import struct
+import logging
+import threading
+
+from store import BaseStore, key_hash
+
+
+MAGIC = "SCSNAP01"
+HEADER = struct.Struct("<8sI")
+ENTRY = struct.Struct("<QdII")
+SNAPSHOT_INTERVAL = 60
+MAX_ENTRIES = 1000000
+
+
+class Snapshot(object):
+    """
+    Снимок, отображённый в память
+    :param buf: содержимое файла (mmap или str)
+    """
+
+    def __init__(self, buf):
+        if len(buf) < HEADER.size:
+            raise ValueError("Not a cache snapshot")
+        magic, self.count = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or len(buf) < HEADER.size + self.count * ENTRY.size:
+            raise ValueError("Not a cache snapshot")
+        self.buf = buf
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :return Snapshot: снимок или None, если файла нет
+        """
+        try:
+            with open(filename, "rb") as f:
+                return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except IOError:
+            return None
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, index):
+        return ENTRY.unpack_from(self.buf, HEADER.size + index * ENTRY.size)
+
+    def get(self, h):
+        """
+        :param int h: хэш ключа
+        :return tuple: (момент истечения, значение) или None
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        entry_hash, expires, offset, length = self.entry(lo)
+        if entry_hash != h:
+            return None
+        return expires, self.buf[offset:offset + length]
+
+    def items(self):
+        for i in xrange(self.count):
+            h, expires, offset, length = self.entry(i)
+            yield h, expires, self.buf[offset:offset + length]
+
+
+def write_snapshot(filename, items, max_entries=MAX_ENTRIES):
+    """
+    Записывает снимок атомарно: во временный файл, который затем переименовывается. Процессы, отобразившие
+    прежний файл, продолжают читать его.
+    :param str filename:
+    :param items: итерируемая последовательность (хэш ключа, момент истечения, значение str),
+        при повторе хэша остаётся последняя запись
+    :param int max_entries: если записей больше, остаются истекающие позже
+    :return int: число записанных записей
+    """
+    now = time.time()
+    entries = {}
+    for h, expires, value in items:
+        if expires > now:
+            entries[h] = (expires, value)
+    if len(entries) > max_entries:
+        entries = dict(heapq.nlargest(max_entries, entries.iteritems(), key=lambda item: item[1][0]))
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        offset = HEADER.size + len(entries) * ENTRY.size
+        hashes = sorted(entries)
+        for h in hashes:
+            expires, value = entries[h]
+            f.write(ENTRY.pack(h, expires, offset, len(value)))
+            offset += len(value)
+        for h in hashes:
+            f.write(entries[h][1])
+    os.rename(tmp, filename)
+    return len(entries)
+
+
+class SnapshotStore(BaseStore):
+    """
+    Хранилище поверх backend, которое при промахе кэша ищет запись в снимке и переносит найденное в кэш backend.
+    Раз в interval секунд кэш backend вместе с уже сохранённым снимком записывается в файл заново. Каждый процесс
+    (в том числе созданный fork) запускает запись в своём потоке при первом обращении к кэшу; процессы,
+    пишущие один файл, дополняют записи друг друга.
+    :param BaseStore backend:
+    :param str filename: файл снимка
+    :param int interval: период записи снимка в секундах, 0 - только по save()
+    :param int max_entries: максимум записей в снимке
+    """
+
+    def __init__(self, backend, filename, interval=SNAPSHOT_INTERVAL, max_entries=MAX_ENTRIES):
+        self.backend = backend
+        self.filename = filename
+        self.interval = interval
+        self.max_entries = max_entries
+        self.writer_pid = None
+        self.start_lock = threading.Lock()
+        self.snapshot = None
+        started = time.time()
+        try:
+            self.snapshot = Snapshot.load(filename)
+        except ValueError, e:
+            logging.warning("Ignoring snapshot %s: %s" % (filename, e))
+        if self.snapshot is not None:
+            logging.info("Snapshot %s mapped: %d entries in %.3fs" % (filename, len(self.snapshot),
+                                                                       time.time() - started))
+
+    @property
+    def has_data(self):
+        return self.backend.has_data
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        return self.backend.get_many(keys)
+
+    def cache_get(self, key):
+        self.start()
+        value = self.backend.cache_get(key)
+        snapshot = self.snapshot
+        if value is not None or snapshot is None:
+            return value
+        entry = snapshot.get(key_hash(key))
+        if entry is None:
+            return None
+        expires, value = entry
+        now = time.time()
+        if expires <= now:
+            return None
+        self.backend.cache_set(key, value, None if expires == float("inf") else expires - now)
+        return value
+
+    def cache_set(self, key, value, ttl=None):
+        self.start()
+        self.backend.cache_set(key, value, ttl)
+
+    def cache_items(self):
+        return self.backend.cache_items()
+
+    def start(self):
+        """
+        Запускает периодическую запись снимка в текущем процессе, если она ещё не запущена
+        """
+        if not self.interval or self.writer_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.writer_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self.run, name="snapshot-writer")
+            thread.daemon = True
+            thread.start()
+            self.writer_pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except Exception:
+                logging.exception("Snapshot %s failed" % self.filename)
+
+    def save(self):
+        """
+        Записывает снимок: записи файла, сохранённые этим или другими процессами, дополняются кэшем backend.
+        После записи записи ищутся уже в новом снимке.
+        :return int: число записанных записей
+        """
+        started = time.time()
+        fd = os.open(self.filename + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            items = []
+            try:
+                current = Snapshot.load(self.filename)
+            except ValueError:
+                current = None
+            if current is not None:
+                items.extend(current.items())
+            items.extend(self.backend.cache_items())
+            count = write_snapshot(self.filename, items, self.max_entries)
+            self.snapshot = Snapshot.load(self.filename)
+        finally:
+            os.close(fd)
+        logging.info("Snapshot %s written: %d entries in %.3fs" % (self.filename, count, time.time() - started))
+        return count
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+import os
+import abc
+import mmap
+import time
+import zlib
+import fcntl
+import socket
+import struct
+import hashlib
+import logging
+
+from Queue import LifoQueue, Empty, Full
+from lru import LRUCache
+
+
+class StoreError(Exception):
+    pass
+
+
+def key_hash(key):
+    """
+    64-битный хэш ключа кэша, которым ключ представлен в разделяемой памяти и снимках. 0 не используется.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0] | 1
+
+
+def encode_value(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else str(value)
+
+
+class BaseStore(object):
+    """
+    Базовый класс хранилища. Кэш (cache_get/cache_set) может быть недоступен - тогда методы
+    молча возвращают None, а недоступность постоянного хранилища (get) всегда приводит к StoreError.
+    """
+    __metaclass__ = abc.ABCMeta
+    # Есть ли у хранилища источник постоянных данных (интересов клиентов)
+    has_data = True
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def cache_get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def cache_set(self, key, value, ttl=None):
+        pass
+
+    def get_many(self, keys):
+        """
+        Возвращает значения для списка ключей в том же порядке, отсутствующие ключи - None
+        :param list keys:
+        :return list:
+        """
+        return [self.get(key) for key in keys]
+
+    def cache_items(self):
+        """
+        Непросроченные записи кэша процесса для снимка. Кэш на внешнем сервере переживает перезапуск сам,
+        поэтому по умолчанию записей нет.
+        :return: итерируемая последовательность (хэш ключа, момент истечения или inf, значение str)
+        """
+        return []
+
+
+class LRUStore(BaseStore):
+    """
+    Хранилище внутри процесса: кэш ограниченного размера с вытеснением по LRU и словарь постоянных данных.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.cache = LRUCache(maxsize)
+        self.data = {}
+
+    @property
+    def has_data(self):
+        # Пустое хранилище процесса заполнить нечем, кроме set()
+        return bool(self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        return map(self.data.get, keys)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def cache_get(self, key):
+        return self.cache.get(key)
+
+    def cache_set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+
+    def cache_items(self):
+        now = time.time()
+        return [(key_hash(key), float("inf") if expires is None else expires, encode_value(value))
+                for key, value, expires in self.cache.items() if expires is None or expires > now]
+
+
+class Connection(object):
+    """
+    Соединение с key-value сервером, говорящим на подмножестве протокола Redis (RESP).
+    """
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile("rb")
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+    @staticmethod
+    def encode(*args):
+        parts = ["*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode("utf-8")
+            else:
+                arg = str(arg)
+            parts.append("$%d\r\n%s\r\n" % (len(arg), arg))
+        return "".join(parts)
+
+    def execute(self, *args):
+        self.sock.sendall(self.encode(*args))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.rfile.readline()
+        if not line.endswith("\r\n"):
+            raise socket.error("Connection closed by server")
+        kind, payload = line[0], line[1:-2]
+        if kind == "+":
+            return payload
+        if kind == "-":
+            raise StoreError(payload)
+        if kind == ":":
+            return int(payload)
+        if kind == "$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.rfile.read(length + 2)
+            if len(data) != length + 2:
+                raise socket.error("Connection closed by server")
+            return data[:-2]
+        if kind == "*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise StoreError(u"Unexpected reply: {}".format(line))
+
+
+class SocketStore(BaseStore):
+    """
+    Хранилище поверх внешнего key-value сервера (Redis или совместимого) с пулом соединений.
+    При сетевой ошибке соединение закрывается и запрос повторяется на новом не более retries раз.
+    """
+
+    def __init__(self, host="localhost", port=6379, timeout=1.0, retries=3, retry_delay=0.05, pool_size=8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool = LifoQueue(pool_size)
+
+    def acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return Connection(self.host, self.port, self.timeout)
+
+    def release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def execute(self, *args):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * attempt)
+            conn = None
+            try:
+                conn = self.acquire()
+                result = conn.execute(*args)
+            except socket.error, e:
+                if conn is not None:
+                    conn.close()
+                error = e
+                continue
+            except StoreError:
+                # Сервер ответил ошибкой, но соединение осталось в рабочем состоянии
+                self.release(conn)
+                raise
+            self.release(conn)
+            return result
+        raise StoreError(u"Store {}:{} is unavailable: {}".format(self.host, self.port, error))
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Empty:
+                break
+
+    def get(self, key):
+        return self.execute("GET", key)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self.execute("MGET", *keys)
+
+    def cache_get(self, key):
+        try:
+            return self.execute("GET", key)
+        except StoreError, e:
+            logging.warning(u"Cache get failed: {}".format(e))
+            return None
+
+    def cache_set(self, key, value, ttl=None):
+        try:
+            if ttl:
+                self.execute("SET", key, value, "EX", int(ttl))
+            else:
+                self.execute("SET", key, value)
+        except StoreError, e:
+            logging.warning(u"Cache set failed: {}".format(e))
+
+
+class SharedMemoryStore(BaseStore):
+    """
+    Кэш в разделяемой памяти (mmap), общий для всех процессов на хосте, поверх хранилища backend,
+    которому передаются get и get_many.
+
+    Кэш - хэш-таблица фиксированного размера с открытой адресацией: ключ ищется в PROBES ячейках подряд,
+    начиная с ячейки по хэшу ключа. При записи занимается ячейка с тем же ключом, пустая или просроченная,
+    а если таких нет - та, что истекает раньше всех. Блокировок нет: ячейка записывается одним копированием,
+    а читатель проверяет её контрольную сумму, поэтому недописанная другим процессом ячейка считается
+    промахом, а не возвращает чужое значение. Значения длиннее VALUE_SIZE байт не кэшируются.
+
+    Без filename память анонимная и разделяется процессами, созданными fork() после создания хранилища
+    (режим -w). С filename к кэшу могут подключиться и независимые процессы.
+    :param BaseStore backend:
+    :param int slots: число ячеек
+    :param str filename: файл для отображения в память
+    """
+    MAGIC = "SCACHE01"
+    HEADER = struct.Struct("<8sII")
+    # хэш ключа, момент истечения, контрольная сумма, длина значения
+    SLOT = struct.Struct("<QdIH")
+    SLOT_SIZE = 64
+    VALUE_SIZE = SLOT_SIZE - SLOT.size
+    PROBES = 8
+
+    def __init__(self, backend=None, slots=65536, filename=None):
+        self.backend = backend if backend is not None else LRUStore()
+        self.slots = slots
+        self.filename = filename
+        size = self.HEADER.size + slots * self.SLOT_SIZE
+        if filename is None:
+            self.buf = mmap.mmap(-1, size)
+            self.buf[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, slots, self.SLOT_SIZE)
+        else:
+            self.buf = self.attach(filename, size)
+
+    def attach(self, filename, size):
+        """
+        Отображает файл кэша в память. Пустой или новый файл размечается, а файл с другой разметкой не трогается:
+        его могут использовать другие процессы, и усечение файла под ними привело бы к SIGBUS.
+        :raises ValueError: если файл размечен под другое число ячеек или не является файлом кэша
+        """
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Первый подключившийся процесс размечает файл, остальные ждут его на блокировке
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = self.HEADER.pack(self.MAGIC, self.slots, self.SLOT_SIZE)
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                os.write(fd, header)
+            elif os.read(fd, self.HEADER.size) != header or os.fstat(fd).st_size < size:
+                raise ValueError("Cache file %s does not match %d slots of %d bytes" % (filename, self.slots,
+                                                                                       self.SLOT_SIZE))
+            buf = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return buf
+        finally:
+            os.close(fd)
+
+    # Хэш ключа не бывает 0, поэтому 0 означает пустую ячейку
+    key_hash = staticmethod(key_hash)
+
+    def offset(self, h, probe):
+        return self.HEADER.size + (h + probe) % self.slots * self.SLOT_SIZE
+
+    def read_slot(self, offset):
+        """
+        :return tuple: (хэш ключа, момент истечения, значение) или None, если ячейка пуста или повреждена
+        """
+        data = self.buf[offset:offset + self.SLOT_SIZE]
+        h, expires, crc, length = self.SLOT.unpack_from(data)
+        if not h or length > self.VALUE_SIZE:
+            return None
+        value = data[self.SLOT.size:self.SLOT.size + length]
+        if self.checksum(h, expires, length, value) != crc:
+            return None
+        return h, expires, value
+
+    @staticmethod
+    def checksum(h, expires, length, value):
+        return zlib.crc32(struct.pack("<QdH", h, expires, length) + value) & 0xffffffff
+
+    @property
+    def has_data(self):
+        return self.backend.has_data
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_many(self, keys):
+        return self.backend.get_many(keys)
+
+    def cache_get(self, key):
+        h = self.key_hash(key)
+        now = time.time()
+        for probe in xrange(self.PROBES):
+            slot = self.read_slot(self.offset(h, probe))
+            if slot is not None and slot[0] == h:
+                return slot[2] if slot[1] > now else None
+        return None
+
+    def cache_set(self, key, value, ttl=None):
+        value = encode_value(value)
+        if len(value) > self.VALUE_SIZE:
+            return
+        h = self.key_hash(key)
+        now = time.time()
+        target, earliest = None, None
+        for probe in xrange(self.PROBES):
+            offset = self.offset(h, probe)
+            slot = self.read_slot(offset)
+            if slot is None or slot[0] == h or slot[1] <= now:
+                target = offset
+                break
+            if earliest is None or slot[1] < earliest:
+                target, earliest = offset, slot[1]
+        expires = now + ttl if ttl else float("inf")
+        crc = self.checksum(h, expires, len(value), value)
+        slot = self.SLOT.pack(h, expires, crc, len(value)) + value
+        self.buf[target:target + len(slot)] = slot
+
+    def cache_items(self):
+        now = time.time()
+        for i in xrange(self.slots):
+            slot = self.read_slot(self.offset(0, i))
+            if slot is not None and slot[1] > now:
+                yield slot
+
+    def clear(self):
+        self.buf[self.HEADER.size:] = "\0" * (len(self.buf) - self.HEADER.size)
+
+
+def make_store(address=None, shared_cache=0, shared_cache_file=None, **kwargs):
+    """
+    Создаёт хранилище по адресу вида host:port, без адреса - хранилище внутри процесса
+    :param str address:
+    :param int shared_cache: число ячеек кэша в разделяемой памяти, 0 - без него
+    :param str shared_cache_file: файл кэша в разделяемой памяти
+    :return BaseStore:
+    """
+    if not address:
+        store = LRUStore()
+    else:
+        host, _, port = address.rpartition(":")
+        store = SocketStore(host or "localhost", int(port), **kwargs)
+    if shared_cache > 0:
+        return SharedMemoryStore(store, shared_cache, shared_cache_file)
+    return store
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import datetime
+
+from scoring_api import api
+
+
+def sign(request):
+    """
+    Подписывает запрос к /method/ действительным токеном, запрос администратора - токеном текущего часа
+    :param dict request:
+    :return dict: тот же запрос
+    """
+    if request.get("login") == api.ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        msg = (request.get("account") or "") + (request.get("login") or "") + api.SALT
+    request["token"] = hashlib.sha512(msg).hexdigest()
+    return request
+
+
+def make_request(method="online_score", account="horns&hoofs", login="h&f", **arguments):
+    """
+    :return dict: подписанный запрос к /method/ с аргументами arguments
+    """
+    return sign({"account": account, "login": login, "method": method, "arguments": arguments})
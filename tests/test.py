@@ -1,9 +1,14 @@
-import hashlib
+# -*- coding: utf-8 -*-
+
 import datetime
 import functools
 import unittest
+import mimetools
+
+from cStringIO import StringIO
 
-from scoring_api import api
+from scoring_api import api, store
+from tests.helpers import sign
 
 
 def cases(cases):
@@ -21,17 +26,12 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.settings = {}
+        # Хранилище по умолчанию, как у сервера без -s
+        self.store = store.make_store()
+        api.response_cache.configure()
 
     def get_response(self, request):
-        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.settings)
-
-    def set_valid_auth(self, request):
-        if request.get("login") == api.ADMIN_LOGIN:
-            request["token"] = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
-        else:
-            msg = request.get("account", "") + request.get("login", "") + api.SALT
-            request["token"] = hashlib.sha512(msg).hexdigest()
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
 
     def test_empty_request(self):
         _, code = self.get_response({})
@@ -52,7 +52,7 @@ class TestSuite(unittest.TestCase):
         {"account": "horns&hoofs", "method": "online_score", "arguments": {}},
     ])
     def test_invalid_method_request(self, request):
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code)
         self.assertTrue(len(response))
@@ -74,7 +74,7 @@ class TestSuite(unittest.TestCase):
     ])
     def test_invalid_score_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
@@ -91,7 +91,7 @@ class TestSuite(unittest.TestCase):
     ])
     def test_ok_score_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.OK, code, arguments)
         score = response.get("score")
@@ -101,7 +101,7 @@ class TestSuite(unittest.TestCase):
     def test_ok_score_admin_request(self):
         arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
         request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": arguments}
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.OK, code)
         score = response.get("score")
@@ -114,10 +114,11 @@ class TestSuite(unittest.TestCase):
         {"client_ids": {1: 2}, "date": "20.07.2017"},
         {"client_ids": ["1", "2"], "date": "20.07.2017"},
         {"client_ids": [1, 2], "date": "XXX"},
+        {"client_ids": range(api.MAX_CLIENT_IDS + 1)},
     ])
     def test_invalid_interests_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
@@ -129,7 +130,7 @@ class TestSuite(unittest.TestCase):
     ])
     def test_ok_interests_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
-        self.set_valid_auth(request)
+        sign(request)
         response, code = self.get_response(request)
         self.assertEqual(api.OK, code, arguments)
         self.assertEqual(len(arguments["client_ids"]), len(response))
@@ -137,6 +138,93 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_admin_digest_rollover(self):
+        digest = api.AdminDigest(grace=60)
+        hour = datetime.datetime(2017, 7, 20, 13)
+        previous = api.AdminDigest.make_digest(hour - datetime.timedelta(hours=1))
+        current = api.AdminDigest.make_digest(hour)
+        self.assertEqual(digest.get_digests(hour + datetime.timedelta(seconds=30)), (current, previous))
+        self.assertEqual(digest.get_digests(hour + datetime.timedelta(minutes=30)), (current,))
+        next_hour = hour + datetime.timedelta(hours=1, seconds=1)
+        self.assertEqual(digest.get_digests(next_hour), (api.AdminDigest.make_digest(next_hour), current))
+
+    def test_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "cached", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        sign(request)
+        api.auth_cache.delete(("horns&hoofs", "cached"))
+        _, code = self.get_response(dict(request, token="bad"))
+        self.assertEqual(api.FORBIDDEN, code)
+        self.assertNotIn(("horns&hoofs", "cached"), api.auth_cache)
+        _, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertIn(("horns&hoofs", "cached"), api.auth_cache)
+        _, code = self.get_response(dict(request, token="bad"))
+        self.assertEqual(api.FORBIDDEN, code)
+
+    def test_request_id_header(self):
+        headers = mimetools.Message(StringIO("X-Request-Id: profile-42\r\n\r\n"))
+        self.assertEqual(api.MainHTTPHandler.get_request_id(headers), "profile-42")
+        self.assertEqual(len(api.MainHTTPHandler.get_request_id(mimetools.Message(StringIO("\r\n")))), 32)
+
+    def test_response_cache(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        sign(request)
+        self.assertEqual(self.get_response(request), ({"score": 3.0}, api.OK))
+        self.assertEqual(len(api.response_cache.cache), 1)
+        # Повтор отдаётся из кэша, не обращаясь к хранилищу
+        self.store = None
+        context, self.context = self.context, {}
+        self.assertEqual(self.get_response(dict(request, arguments=dict(request["arguments"]))),
+                         ({"score": 3.0}, api.OK))
+        self.assertEqual(sorted(self.context["has"]), sorted(context["has"]))
+        # Другой токен и ошибки не попадают в кэш
+        _, code = self.get_response(dict(request, token="bad"))
+        self.assertEqual(api.FORBIDDEN, code)
+        self.assertEqual(len(api.response_cache.cache), 1)
+        # Необъявленное поле отклоняется проверкой и при закэшированном ответе
+        _, code = self.get_response(dict(request, extra="field"))
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+    def test_response_cache_opt_out(self):
+        api.response_cache.configure(opt_out=["horns&hoofs"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        sign(request)
+        admin = {"account": "other", "login": "admin", "method": "online_score",
+                 "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        sign(admin)
+        for r in (request, admin):
+            self.assertEqual(self.get_response(r)[1], api.OK)
+        self.assertEqual(len(api.response_cache.cache), 0)
+
+    @cases([False, True])
+    def test_batch_request(self, parallel):
+        requests = [
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"first_name": "a", "last_name": "b"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+             "arguments": {"client_ids": [1, 2]}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {"phone": "1"}},
+        ]
+        for request in requests:
+            sign(request)
+        requests.append({"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "bad",
+                         "arguments": {}})
+        response, code = api.batch_handler({"body": {"requests": requests, "parallel": parallel}}, self.context,
+                                           self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([r["code"] for r in response], [api.OK, api.OK, api.INVALID_REQUEST, api.FORBIDDEN])
+        self.assertEqual(response[0]["response"], {"score": 0.5})
+        self.assertEqual(len(response[1]["response"]), 2)
+        self.assertEqual(self.context["nrequests"], 4)
+
+    @cases([[], {}, {"requests": "x"}, [{}] * (api.MAX_BATCH_SIZE + 1)])
+    def test_invalid_batch_request(self, body):
+        _, code = api.batch_handler({"body": body}, self.context, self.store)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
 
 if __name__ == "__main__":
     unittest.main()
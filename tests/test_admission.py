@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from scoring_api import api, admission
+from tests.helpers import make_request
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def test_rate(self):
+        control = admission.AdmissionControl(rate=0.001, burst=2)
+        self.assertEqual([control.acquire("a") for _ in range(3)], [None, None, admission.RATE])
+        self.assertIsNone(control.acquire("b"))
+
+    def test_concurrency(self):
+        control = admission.AdmissionControl(concurrency=1)
+        self.assertIsNone(control.acquire("a"))
+        self.assertEqual(control.acquire("a"), admission.CONCURRENCY)
+        control.release("a")
+        self.assertIsNone(control.acquire("a"))
+
+    def test_in_flight(self):
+        control = admission.AdmissionControl(max_in_flight=1)
+        self.assertTrue(control.enter())
+        self.assertFalse(control.enter())
+        control.leave()
+        self.assertTrue(control.enter())
+        self.assertEqual(control.in_flight, 1)
+
+
+class TestApiAdmission(unittest.TestCase):
+    def setUp(self):
+        api.response_cache.configure(maxsize=0)
+
+    def tearDown(self):
+        api.admission.configure()
+        api.response_cache.configure()
+
+    def test_rate_limit(self):
+        api.admission.configure(rate=0.001, burst=1)
+        codes = [api.method_handler({"body": make_request(account=account, phone="79175002040", email="a@b.ru"), "headers": {}}, {}, None)[1]
+                 for account in ("spiky", "spiky", "quiet")]
+        self.assertEqual(codes, [api.OK, api.TOO_MANY_REQUESTS, api.OK])
+
+    def test_rate_limit_with_response_cache(self):
+        # Повторы одного запроса, ответ на который уже в кэше, тоже ограничиваются
+        api.response_cache.configure()
+        api.admission.configure(rate=0.001, burst=1)
+        codes = [api.method_handler({"body": make_request(account="retry", phone="79175002040", email="a@b.ru"), "headers": {}}, {}, None)[1] for _ in range(5)]
+        self.assertEqual(codes, [api.OK] + [api.TOO_MANY_REQUESTS] * 4)
+        self.assertEqual(len(api.response_cache.cache), 1)
+
+    def test_in_flight_limit(self):
+        api.admission.configure(max_in_flight=1)
+        self.assertTrue(api.admission.enter())
+        try:
+            code, r = api.process_request(api.MainHTTPHandler.router, "/method/", "{}", {}, {"request_id": "1"},
+                                          None)
+        finally:
+            api.admission.leave()
+        self.assertEqual(code, api.SERVICE_UNAVAILABLE)
+        self.assertEqual(r["error"], api.ERRORS[api.SERVICE_UNAVAILABLE])
+        self.assertEqual(api.admission.in_flight, 0)
+        self.assertIn('scoring_admission_rejected_total{reason="in_flight"}', api.get_metrics())
+
+
+if __name__ == "__main__":
+    unittest.main()
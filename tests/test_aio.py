@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import socket
+import httplib
+import threading
+import unittest
+
+from scoring_api import api, aio, store, scoring
+from tests.helpers import make_request
+
+
+class BlockingStore(store.LRUStore):
+    """Отдаёт первую пачку интересов сразу, а следующие - только после release"""
+
+    def __init__(self):
+        store.LRUStore.__init__(self)
+        self.set("i:0", '["cars"]')
+        self.release = threading.Event()
+        self.calls = 0
+
+    def get_many(self, keys):
+        self.calls += 1
+        if self.calls > 1:
+            self.release.wait(5)
+        return store.LRUStore.get_many(self, keys)
+
+
+class TestAsyncServer(unittest.TestCase):
+    threads = 0
+
+    def setUp(self):
+        self.server = aio.AsyncHTTPServer(("localhost", 0), store=store.LRUStore(), threads=self.threads)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        for _ in range(3):
+            conn.request("POST", "/method/", json.dumps(make_request(first_name="a", last_name="b")))
+            response = conn.getresponse()
+            self.assertEqual(response.status, api.OK)
+            self.assertEqual(json.loads(response.read())["response"], {"score": 0.5})
+        conn.close()
+
+    def test_pipelining(self):
+        bodies = [json.dumps(make_request(first_name="a", last_name="b")), "{bad json",
+                  json.dumps(make_request(phone="79175002040", email="a@b.ru"))]
+        data = "".join("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(b), b) for b in bodies)
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+        sock.sendall(data)
+        rfile = sock.makefile("rb")
+        codes = []
+        for _ in bodies:
+            self.assertTrue(rfile.readline().startswith("HTTP/1.1"))
+            headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+            codes.append(json.loads(rfile.read(int(headers["Content-Length"])))["code"])
+        sock.close()
+        self.assertEqual(codes, [api.OK, api.BAD_REQUEST, api.OK])
+
+    def read_responses(self, sock, count):
+        rfile = sock.makefile("rb")
+        responses = []
+        for _ in range(count):
+            status = int(rfile.readline().split()[1])
+            headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+            if headers.get("Transfer-Encoding") == "chunked":
+                body = "".join(iter(lambda: rfile.read(int(rfile.readline(), 16) + 2)[:-2], ""))
+            else:
+                body = rfile.read(int(headers["Content-Length"]))
+            responses.append((status, headers, json.loads(body)))
+        self.assertEqual(rfile.read(), "")
+        return responses
+
+    def test_pipelined_bad_request(self):
+        # Ошибка разбора отправляется после ответов на уже принятые запросы
+        bodies = [json.dumps(make_request("clients_interests", client_ids=range(50))),
+                  json.dumps(make_request(first_name="a", last_name="b"))]
+        data = "".join("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(b), b) for b in bodies)
+        old, api.STREAM_MIN_CLIENTS = api.STREAM_MIN_CLIENTS, 10
+        try:
+            sock = socket.create_connection(("localhost", self.port), timeout=5)
+            sock.sendall(data + "GARBAGE\r\n\r\n")
+            responses = self.read_responses(sock, 3)
+            sock.close()
+        finally:
+            api.STREAM_MIN_CLIENTS = old
+        self.assertEqual([status for status, _, _ in responses], [api.OK, api.OK, api.BAD_REQUEST])
+        self.assertEqual(len(responses[0][2]["response"]), 50)
+        self.assertEqual(responses[1][2]["response"], {"score": 0.5})
+        self.assertEqual(responses[2][2]["error"], "Bad request line")
+
+    def test_negative_content_length(self):
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+        sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: -5\r\n\r\n{}")
+        [(status, headers, body)] = self.read_responses(sock, 1)
+        sock.close()
+        self.assertEqual(status, api.BAD_REQUEST)
+        self.assertEqual(headers["Connection"], "close")
+
+    def test_streaming_response(self):
+        request = make_request("clients_interests", client_ids=range(50))
+        old, api.STREAM_MIN_CLIENTS = api.STREAM_MIN_CLIENTS, 10
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+            for _ in range(2):
+                conn.request("POST", "/method/", json.dumps(request))
+                response = conn.getresponse()
+                self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+                self.assertEqual(len(json.loads(response.read())["response"]), 50)
+            conn.close()
+        finally:
+            api.STREAM_MIN_CLIENTS = old
+
+    def test_stream_holds_admission(self):
+        self.server.store = blocking = BlockingStore()
+        request = make_request("clients_interests", client_ids=range(scoring.INTERESTS_CHUNK_SIZE * 2))
+        old, api.STREAM_MIN_CLIENTS = api.STREAM_MIN_CLIENTS, 10
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+            conn.request("POST", "/method/", json.dumps(request))
+            response = conn.getresponse()
+            deadline = time.time() + 5
+            while blocking.calls < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            # Ответ ещё отдаётся, поэтому запрос учитывается среди обрабатываемых
+            self.assertEqual(api.admission.in_flight, 1)
+            blocking.release.set()
+            body = json.loads(response.read())
+            conn.close()
+        finally:
+            api.STREAM_MIN_CLIENTS = old
+        self.assertEqual(len(body["response"]), scoring.INTERESTS_CHUNK_SIZE * 2)
+        self.assertEqual(body["response"]["0"], ["cars"])
+        while api.admission.in_flight and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(api.admission.in_flight, 0)
+
+    def test_body_limits(self):
+        self.server.body_timeout = 0.1
+        for request, code in [("Content-Length: %d\r\n\r\n{}" % (api.MAX_BODY_SIZE + 1), api.REQUEST_ENTITY_TOO_LARGE),
+                              ("Content-Length: 100\r\n\r\n{", api.REQUEST_TIMEOUT)]:
+            sock = socket.create_connection(("localhost", self.port), timeout=5)
+            sock.sendall("POST /method/ HTTP/1.1\r\n" + request)
+            rfile = sock.makefile("rb")
+            self.assertTrue(rfile.readline().startswith("HTTP/1.1 %d" % code))
+            headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+            self.assertEqual(headers["Connection"], "close")
+            self.assertEqual(json.loads(rfile.read(int(headers["Content-Length"])))["code"], code)
+            self.assertEqual(rfile.read(), "")
+            sock.close()
+
+    def test_metrics(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        conn.request("GET", "/metrics/")
+        response = conn.getresponse()
+        self.assertEqual(response.status, api.OK)
+        self.assertIn("scoring_requests_total", response.read())
+        conn.close()
+
+    def test_unknown_path(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        conn.request("POST", "/unknown/", json.dumps(make_request()))
+        self.assertEqual(conn.getresponse().status, api.NOT_FOUND)
+        conn.close()
+
+
+class TestAsyncServerWithPool(TestAsyncServer):
+    threads = 2
+
+
+if __name__ == "__main__":
+    unittest.main()
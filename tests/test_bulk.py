@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from cStringIO import StringIO
+
+from scoring_api import api, bulk
+
+
+class TestBulk(unittest.TestCase):
+    ndjson = "\n".join([
+        '{"phone": "79175002040", "email": "a@b.ru"}',
+        '',
+        '{bad json',
+        '{"first_name": "a", "last_name": "b", "birthday": "01.01.2000", "gender": 1}',
+        '{"phone": "79175002040"}',
+        'null',
+        '{"email": "bad"}',
+    ])
+
+    def run_bulk(self, data, fmt="ndjson", method="online_score", workers=0):
+        records = bulk.read_records(StringIO(data), fmt)
+        return [json.loads(line) for line in bulk.run(records, method, workers=workers, chunk_size=2)]
+
+    def test_online_score(self):
+        for workers in (0, 2):
+            results = self.run_bulk(self.ndjson, workers=workers)
+            self.assertEqual([r["code"] for r in results],
+                             [api.OK, api.BAD_REQUEST, api.OK, api.INVALID_REQUEST, api.INVALID_REQUEST,
+                              api.INVALID_REQUEST])
+            self.assertEqual(results[0]["response"], {"score": 3.0})
+            self.assertEqual(results[2]["response"], {"score": 2.0})
+
+    def test_csv(self):
+        data = "phone,email,gender,birthday,first_name,last_name\n" \
+               "79175002040,a@b.ru,,,,\n" \
+               ",,1,01.01.2000,a,b\n" \
+               ",,x,01.01.2000,,\n"
+        results = self.run_bulk(data, fmt="csv")
+        self.assertEqual([r.get("response") for r in results], [{"score": 3.0}, {"score": 2.0}, None])
+        self.assertIn("gender", results[2]["error"])
+
+    def test_clients_interests(self):
+        data = "client_ids\n1 2 2\nx\n"
+        results = self.run_bulk(data, fmt="csv", method="clients_interests")
+        self.assertEqual(results[0]["code"], api.OK)
+        self.assertEqual(sorted(results[0]["response"]), ["1", "2"])
+        self.assertEqual(results[1]["code"], api.INVALID_REQUEST)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from scoring_api import api, catalog, codec
+from tests.helpers import make_request
+
+
+PAIRS = [(0, ["cars", "pets"]), (3, ["pets"]), (5, ["otus", "unknown"]), (2, []), (4, ["cars"])]
+
+
+class TestInterestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "interests.icat")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, c):
+        self.assertEqual(len(c), 6)
+        self.assertEqual(c.get(0), ["cars", "pets"])
+        self.assertEqual(c.get(1), [])
+        self.assertEqual(c.get(5), ["otus"])
+        self.assertEqual(c.get(100), [])
+        self.assertEqual(c.get(-1), [])
+        self.assertEqual(c.clients("cars"), [0, 4])
+        self.assertEqual(c.clients("pets", offset=1), [3])
+        self.assertEqual(c.clients("pets", limit=1), [0])
+        self.assertEqual(c.clients("unknown"), [])
+        self.assertEqual(c.count("pets"), 2)
+        self.assertEqual(list(c.iter_many([0, 3, 0, 9], chunk_size=2)),
+                         [[(0, ["cars", "pets"]), (3, ["pets"])], [(9, [])]])
+
+    def test_build(self):
+        self.check(catalog.InterestCatalog.build(PAIRS))
+
+    def test_save_and_load(self):
+        catalog.InterestCatalog.build(PAIRS).save(self.filename)
+        loaded = catalog.InterestCatalog.load(self.filename)
+        self.assertIsInstance(loaded.masks, catalog.MappedArray)
+        self.check(loaded)
+
+    def test_decoded_lists_are_preencoded(self):
+        c = catalog.InterestCatalog.build(PAIRS)
+        self.assertIs(codec.dumps(c.get(0)), codec.dumps(c.get(0)))
+
+
+class TestCatalogMethods(unittest.TestCase):
+    def setUp(self):
+        api.interest_catalog = catalog.InterestCatalog.build(PAIRS)
+
+    def tearDown(self):
+        api.interest_catalog = None
+
+    def call(self, method, arguments):
+        return api.method_handler({"body": make_request(method, **arguments), "headers": {}}, {}, None)
+
+    def test_clients_interests(self):
+        response, code = self.call("clients_interests", {"client_ids": [0, 5]})
+        self.assertEqual(code, api.OK)
+        self.assertEqual(response, {0: ["cars", "pets"], 5: ["otus"]})
+
+    def test_clients_by_interest(self):
+        response, code = self.call("clients_by_interest", {"interest": "pets", "offset": 1, "limit": 10})
+        self.assertEqual(code, api.OK)
+        self.assertEqual(response, {"count": 2, "offset": 1, "client_ids": [3]})
+        for arguments in ({"interest": "unknown"}, {"interest": "pets", "limit": 0}, {"interest": "pets",
+                                                                                     "offset": "1"}, {}):
+            _, code = self.call("clients_by_interest", arguments)
+            self.assertEqual(code, api.INVALID_REQUEST)
+
+    def test_without_catalog(self):
+        api.interest_catalog = None
+        _, code = self.call("clients_by_interest", {"interest": "pets"})
+        self.assertEqual(code, api.INVALID_REQUEST)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import json
+import unittest
+
+from scoring_api import api, codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_envelope(self):
+        r = {"code": api.OK, "response": {1: ["cars"], 2: []}}
+        self.assertEqual(json.loads("".join(codec.encode_response(r))),
+                         {"code": api.OK, "response": {"1": ["cars"], "2": []}})
+
+    def test_standard_errors_are_preencoded(self):
+        first = codec.encode_response({"code": api.NOT_FOUND, "error": api.ERRORS[api.NOT_FOUND]})
+        second = codec.encode_response({"code": api.NOT_FOUND, "error": api.ERRORS[api.NOT_FOUND]})
+        self.assertIs(first[0], second[0])
+        self.assertEqual(json.loads(first[0]), {"code": api.NOT_FOUND, "error": "Not Found"})
+        custom = codec.encode_response({"code": api.INVALID_REQUEST, "error": {"phone": "bad"}})
+        self.assertEqual(json.loads("".join(custom))["error"], {"phone": "bad"})
+
+    def test_object_stream(self):
+        stream = codec.ObjectStream(iter([[(1, ["cars"]), (2, [])], [], [(3, ["tv"])]]))
+        chunks = codec.encode_response({"code": api.OK, "response": stream})
+        self.assertFalse(isinstance(chunks, list))
+        self.assertEqual(json.loads("".join(chunks)),
+                         {"code": api.OK, "response": {"1": ["cars"], "2": [], "3": ["tv"]}})
+        empty = codec.encode_response({"code": api.OK, "response": codec.ObjectStream([])})
+        self.assertEqual(json.loads("".join(empty)), {"code": api.OK, "response": {}})
+
+    def test_stream_close(self):
+        closed = []
+        stream = codec.ObjectStream(iter([[(1, [])], [(2, [])]]))
+        stream.on_close(lambda: closed.append("first"))
+        stream.on_close(lambda: closed.append("second"))
+        chunks = codec.encode_response({"code": api.OK, "response": stream})
+        next(iter(chunks))
+        chunks.close()
+        chunks.close()
+        self.assertEqual(closed, ["second", "first"])
+
+    def test_constants(self):
+        self.assertIs(codec.dumps(api.ADMIN_SCORE_RESPONSE), codec.dumps(api.ADMIN_SCORE_RESPONSE))
+        self.assertEqual(json.loads(codec.dumps(api.ADMIN_SCORE_RESPONSE)), {"score": 42})
+        self.assertEqual(codec.dumps({"score": 42}), codec.dumps(api.ADMIN_SCORE_RESPONSE))
+
+
+if __name__ == "__main__":
+    unittest.main()
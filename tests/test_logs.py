@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+import unittest
+
+from Queue import Queue
+from StringIO import StringIO
+
+from scoring_api import logs
+
+
+class TestQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+        target = logging.StreamHandler(self.stream)
+        target.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.handler = logs.QueueHandler(target, maxsize=100)
+        self.logger = logging.getLogger("test_logs")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_records_written_in_background(self):
+        self.logger.info(u"request %s", u"Иван")
+        self.logger.debug("payload %s", {"a": 1})
+        self.handler.close()
+        self.assertEqual(self.stream.getvalue().decode("utf-8").splitlines(),
+                         [u"INFO request Иван", u"DEBUG payload {'a': 1}"])
+
+    def test_full_queue_drops_records(self):
+        # Имитируем остановившийся поток записи: очередь на одну запись и никто её не разбирает
+        self.handler.pid, self.handler.queue = os.getpid(), Queue(1)
+        for i in range(3):
+            self.logger.info("record %s", i)
+        self.assertEqual(self.handler.dropped, 2)
+
+    def test_sampling(self):
+        self.handler.addFilter(logs.SamplingFilter(0.0))
+        self.logger.info("sampled", extra=logs.SAMPLED)
+        self.logger.info("kept")
+        self.handler.close()
+        self.assertEqual(self.stream.getvalue(), "INFO kept\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
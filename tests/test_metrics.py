@@ -0,0 +1,58 @@
+import threading
+import unittest
+
+from scoring_api import api, store
+from scoring_api.metrics import Registry, registry
+from tests.helpers import make_request
+
+
+class TestRegistry(unittest.TestCase):
+    def test_threads_are_merged(self):
+        registry = Registry(buckets=(0.1, 1.0))
+        registry.describe("requests_total", "counter", "Requests")
+
+        def work():
+            for _ in range(100):
+                registry.inc("requests_total", (("code", 200),))
+                registry.observe("latency_seconds", (), 0.5)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        registry.observe("latency_seconds", (), 2.0)
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE requests_total counter", lines)
+        self.assertIn('requests_total{code="200"} 400.0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 400', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 401', lines)
+        self.assertIn('latency_seconds_count 401', lines)
+
+    def test_gauges(self):
+        registry = Registry()
+        registry.gauge("in_flight", "In flight requests", lambda: 3)
+        registry.gauge("per_account", "Per account", lambda: [((("account", "a"),), 1)])
+        lines = registry.render().splitlines()
+        self.assertIn("in_flight 3.0", lines)
+        self.assertIn('per_account{account="a"} 1.0', lines)
+
+
+class TestMethodMetrics(unittest.TestCase):
+    def test_unexpected_error_is_counted(self):
+        class BrokenStore(store.LRUStore):
+            def cache_get(self, key):
+                raise store.StoreError("unavailable")
+
+        request = make_request(phone="79175002040", email="a@b.ru")
+        key = ("scoring_method_requests_total", (("method", "online_score"), ("code", api.INTERNAL_ERROR)))
+        before = registry.collect()[0].get(key, 0)
+        with self.assertRaises(store.StoreError):
+            api.method_handler({"body": request, "headers": {}}, {}, BrokenStore())
+        self.assertEqual(registry.collect()[0].get(key, 0), before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
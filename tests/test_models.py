@@ -0,0 +1,79 @@
+import datetime
+import unittest
+
+from scoring_api import api, models
+from scoring_api.models import Model, CharField, DateField
+
+
+class TestModels(unittest.TestCase):
+    def test_plan_built_at_class_creation(self):
+        self.assertEqual(set(api.MethodRequest.fields), {"account", "login", "token", "arguments", "method"})
+        self.assertEqual(api.MethodRequest.required_fields, {"login", "token", "arguments", "method"})
+        self.assertIsNotNone(api.OnlineScoreRequest.fields["email"].regex)
+
+    def test_validate_collects_all_errors(self):
+        request = api.OnlineScoreRequest({"email": "bad", "phone": "79175002040", "unknown": 1, "first_name": ""})
+        self.assertEqual(set(request.errors), {"email", "unknown"})
+        self.assertEqual(request.phone, "79175002040")
+        self.assertEqual(request.first_name, "")
+        self.assertIsNone(request.last_name)
+
+        request = api.MethodRequest({"method": "online_score", "login": "h&f"})
+        self.assertEqual(set(request.errors), {"token", "arguments"})
+
+    def test_blank_values(self):
+        field = CharField(nullable=False)
+        for value in ["", u"", (), [], {}, None]:
+            self.assertTrue(field.is_blank(value), value)
+        for value in [0, False, "a", [0]]:
+            self.assertFalse(field.is_blank(value), value)
+
+    def test_compact_models(self):
+        request = api.MethodRequest({"login": "h&f", "token": "t", "arguments": {}, "method": "online_score"})
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual(request.login, "h&f")
+        self.assertIsNone(request.account)
+        self.assertTrue(request.is_valid())
+        request.account = "horns&hoofs"
+        self.assertEqual(request.account, "horns&hoofs")
+        with self.assertRaises(AttributeError):
+            request.unknown = 1
+
+    def test_regular_models_keep_dict(self):
+        class Request(Model):
+            name = CharField(required=True)
+
+        request = Request({"name": "a"})
+        self.assertEqual(request.__dict__, {"name": "a", "errors": {}})
+
+    def test_parse_date(self):
+        self.assertEqual(models.parse_date("29.02.2000"), datetime.date(2000, 2, 29))
+        self.assertEqual(models.parse_date(u"1.2.2000"), datetime.date(2000, 2, 1))
+        for value in ["29.02.2001", "2000.01.01", "01.01.00", "32.01.2000", "", "01.01.2000\n"]:
+            self.assertIsNone(models.parse_date(value), value)
+        self.assertIn("29.02.2000", models._date_cache)
+
+    def test_birthday_cutoff(self):
+        field = api.OnlineScoreRequest.fields["birthday"]
+        today = datetime.date.today()
+        oldest = today - datetime.timedelta(days=field.max_age * 365)
+        self.assertEqual(field.get_cutoff(), oldest)
+        self.assertFalse(field.check_value(oldest.strftime("%d.%m.%Y")))
+        self.assertTrue(field.check_value((oldest + datetime.timedelta(days=1)).strftime("%d.%m.%Y")))
+
+    def test_parsed_date_retained(self):
+        request = api.OnlineScoreRequest({"birthday": "01.02.2000", "gender": 1})
+        self.assertEqual(request.birthday, "01.02.2000")
+        self.assertEqual(request.birthday_date, datetime.date(2000, 2, 1))
+        self.assertIsNone(api.ClientsInterestsRequest({"client_ids": [1]}).date_date)
+        request.birthday = "02.02.2000"
+        self.assertEqual(request.birthday_date, datetime.date(2000, 2, 2))
+
+        class Request(Model):
+            date = DateField(required=True)
+
+        self.assertEqual(Request({"date": "03.02.2000"}).date_date, datetime.date(2000, 2, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import sys
+import shutil
+import pstats
+import tempfile
+import unittest
+
+from scoring_api import api, profiling, store
+from tests.helpers import make_request
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler(self.directory, rate=0.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sample(self):
+        self.assertFalse(self.profiler.sample("profile-1"))
+        self.profiler.enable()
+        self.assertTrue(self.profiler.sample("profile-1"))
+        self.assertFalse(self.profiler.sample("other"))
+        self.profiler.rate = 1.0
+        self.assertTrue(self.profiler.sample(None))
+
+    def test_dump(self):
+        self.profiler.enable()
+        for _ in range(2):
+            profile = self.profiler.start("profile-1")
+            sorted(range(100))
+            self.profiler.stop(profile, "online_score")
+        self.assertEqual(self.profiler.status()["calls"], {"online_score": 2})
+        filenames = self.profiler.disable()
+        self.assertEqual(len(filenames), 1)
+        self.assertTrue(pstats.Stats(filenames[0]).total_calls > 0)
+        self.assertEqual(self.profiler.status()["calls"], {})
+
+
+class TestProfileMethod(unittest.TestCase):
+    def request(self, login, action):
+        request = make_request("profile", login=login, action=action)
+        return api.method_handler({"body": request, "headers": {}}, {"request_id": "profile-1"}, None)
+
+    def test_admin_only(self):
+        _, code = self.request("h&f", "start")
+        self.assertEqual(code, api.FORBIDDEN)
+        self.assertFalse(api.profiler.enabled)
+
+    def test_start_stop(self):
+        directory, api.profiler.directory = api.profiler.directory, None
+        try:
+            response, code = self.request(api.ADMIN_LOGIN, "start")
+            self.assertEqual(code, api.OK)
+            self.assertTrue(response["enabled"])
+            self.request(api.ADMIN_LOGIN, "status")
+            response, code = self.request(api.ADMIN_LOGIN, "status")
+            self.assertEqual(response["calls"].get("profile"), 1)
+            response, code = self.request(api.ADMIN_LOGIN, "stop")
+            self.assertFalse(response["enabled"])
+            _, code = self.request(api.ADMIN_LOGIN, "restart")
+            self.assertEqual(code, api.INVALID_REQUEST)
+        finally:
+            api.profiler.enabled = False
+            api.profiler.directory = directory
+
+    def test_stopped_after_unexpected_error(self):
+        class BrokenStore(store.LRUStore):
+            def cache_get(self, key):
+                raise store.StoreError("unavailable")
+
+        request = make_request(phone="79175002040", email="a@b.ru")
+        api.profiler.enabled = True
+        try:
+            with self.assertRaises(store.StoreError):
+                api.method_handler({"body": request, "headers": {}}, {"request_id": "profile-1"}, BrokenStore())
+            self.assertIsNone(sys.getprofile())
+        finally:
+            api.profiler.enabled = False
+            api.profiler.dump()
+
+
+if __name__ == "__main__":
+    unittest.main()
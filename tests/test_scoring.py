@@ -0,0 +1,41 @@
+import unittest
+
+from scoring_api import scoring
+
+
+class TestBulkScoring(unittest.TestCase):
+    records = [
+        {},
+        {"phone": "79175002040"},
+        {"phone": "79175002040", "email": "a@b.ru"},
+        {"birthday": "01.01.2000", "gender": 1},
+        {"birthday": "01.01.2000", "gender": 0},
+        {"first_name": "a", "last_name": "b"},
+        {"first_name": "a"},
+        {"phone": "79175002040", "email": "a@b.ru", "birthday": "01.01.2000", "gender": 2, "first_name": "a",
+         "last_name": "b"},
+    ]
+
+    def expected(self):
+        return [scoring.get_score(None, r.get("phone"), r.get("email"), r.get("birthday"), r.get("gender"),
+                                  r.get("first_name"), r.get("last_name")) for r in self.records]
+
+    def test_get_scores(self):
+        scores = scoring.get_scores(*scoring.get_presence(self.records))
+        self.assertEqual([float(s) for s in scores], self.expected())
+
+    def test_get_scores_without_numpy(self):
+        numpy, scoring.numpy = scoring.numpy, None
+        try:
+            scores = scoring.get_scores(*scoring.get_presence(self.records))
+        finally:
+            scoring.numpy = numpy
+        self.assertEqual(scores, self.expected())
+
+    def test_columns_length(self):
+        self.assertEqual(list(scoring.get_scores([], [], [], [])), [])
+        self.assertRaises(ValueError, scoring.get_scores, [True], [True], [True], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import socket
+import httplib
+import threading
+import unittest
+
+from scoring_api import api, server
+from tests.helpers import make_request
+
+
+class TestThreadPoolServer(unittest.TestCase):
+    def setUp(self):
+        self.server = server.make_server(("localhost", 0), api.MainHTTPHandler, threads=2)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def post(self, path, body):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_concurrent_requests(self):
+        request = make_request(first_name="a", last_name="b")
+        results = []
+
+        def call():
+            results.append(self.post("/method/", request))
+
+        clients = [threading.Thread(target=call) for _ in range(8)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        self.assertEqual(len(results), 8)
+        for status, body in results:
+            self.assertEqual(status, api.OK)
+            self.assertEqual(body["code"], api.OK)
+            self.assertEqual(body["response"]["score"], 0.5)
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        sockets = set()
+        for _ in range(3):
+            conn.request("POST", "/method/", json.dumps(make_request(first_name="a", last_name="b")))
+            response = conn.getresponse()
+            self.assertEqual(response.status, api.OK)
+            self.assertEqual(int(response.getheader("Content-Length")), len(response.read()))
+            sockets.add(conn.sock)
+        conn.close()
+        self.assertEqual(len(sockets), 1)
+
+    def test_metrics(self):
+        self.post("/method/", make_request(first_name="a", last_name="b"))
+        conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        self.assertEqual(response.status, api.OK)
+        self.assertTrue(response.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('scoring_method_requests_total{method="online_score",code="200"}', body)
+        self.assertIn('scoring_stage_seconds_count{stage="auth"}', body)
+
+    def test_streaming_response(self):
+        request = make_request("clients_interests", client_ids=range(50) + [0, 1])
+        old, api.STREAM_MIN_CLIENTS = api.STREAM_MIN_CLIENTS, 10
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+            for _ in range(2):
+                conn.request("POST", "/method/", json.dumps(request))
+                response = conn.getresponse()
+                self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+                body = json.loads(response.read())
+                self.assertEqual(body["code"], api.OK)
+                self.assertEqual(sorted(body["response"], key=int), [str(i) for i in range(50)])
+            conn.close()
+        finally:
+            api.STREAM_MIN_CLIENTS = old
+
+    def read_response(self, sock):
+        rfile = sock.makefile("rb")
+        status = rfile.readline().split()[1]
+        headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+        return int(status), headers, json.loads(rfile.read(int(headers["Content-Length"])))
+
+    def test_body_too_large(self):
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+        sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n{}" % (api.MAX_BODY_SIZE + 1))
+        status, headers, body = self.read_response(sock)
+        sock.close()
+        self.assertEqual(status, api.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(headers["Connection"], "close")
+        self.assertEqual(body["code"], api.REQUEST_ENTITY_TOO_LARGE)
+
+    def test_body_timeout(self):
+        old, api.MainHTTPHandler.body_timeout = api.MainHTTPHandler.body_timeout, 0.2
+        try:
+            sock = socket.create_connection(("localhost", self.port), timeout=5)
+            sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: 100\r\n\r\n{")
+            status, headers, body = self.read_response(sock)
+            sock.close()
+        finally:
+            api.MainHTTPHandler.body_timeout = old
+        self.assertEqual(status, api.REQUEST_TIMEOUT)
+        self.assertEqual(headers["Connection"], "close")
+
+    def test_body_timeout_slow_drip(self):
+        # Клиент присылает тело по байту: каждый recv успевает получить данные, но общий срок истекает
+        old, api.MainHTTPHandler.body_timeout = api.MainHTTPHandler.body_timeout, 0.3
+        stop = threading.Event()
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+
+        def drip():
+            try:
+                sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: 1000\r\n\r\n")
+                while not stop.wait(0.02):
+                    sock.sendall(" ")
+            except socket.error:
+                pass
+
+        dripper = threading.Thread(target=drip)
+        started = time.time()
+        try:
+            dripper.start()
+            status, headers, body = self.read_response(sock)
+            elapsed = time.time() - started
+        finally:
+            stop.set()
+            dripper.join()
+            sock.close()
+            api.MainHTTPHandler.body_timeout = old
+        self.assertEqual(status, api.REQUEST_TIMEOUT)
+        self.assertLess(elapsed, 1.5)
+
+    def test_pipelined_body(self):
+        # Тело и следующий запрос, пришедшие одним пакетом с заголовками, не теряются
+        body = json.dumps(make_request(first_name="a", last_name="b"))
+        data = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+        sock.sendall(data * 2)
+        rfile = sock.makefile("rb")
+        for _ in range(2):
+            status = int(rfile.readline().split()[1])
+            headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+            self.assertEqual(status, api.OK)
+            self.assertEqual(json.loads(rfile.read(int(headers["Content-Length"])))["response"], {"score": 0.5})
+        sock.close()
+
+    def test_body_split_across_segments(self):
+        # Заголовки и начало тела приходят одним сегментом, остаток тела - вместе со следующим запросом
+        body = json.dumps(make_request(first_name="a", last_name="b"))
+        data = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        split = data.index("\r\n\r\n") + 4 + len(body) // 2
+        sock = socket.create_connection(("localhost", self.port), timeout=5)
+        sock.sendall(data[:split])
+        time.sleep(0.05)
+        sock.sendall(data[split:] + data)
+        rfile = sock.makefile("rb")
+        for _ in range(2):
+            status = int(rfile.readline().split()[1])
+            headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+            self.assertEqual(status, api.OK)
+            self.assertEqual(json.loads(rfile.read(int(headers["Content-Length"])))["response"], {"score": 0.5})
+        sock.close()
+
+    def test_queue_overflow(self):
+        srv = server.make_server(("localhost", 0), api.MainHTTPHandler, threads=1, queue_size=1)
+        thread = threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.start()
+        address = srv.server_address
+        try:
+            # Первое соединение занимает единственный поток, второе ждёт в очереди
+            busy = socket.create_connection(address, timeout=5)
+            time.sleep(0.1)
+            queued = socket.create_connection(address, timeout=5)
+            time.sleep(0.1)
+            rejected = socket.create_connection(address, timeout=5)
+            self.assertTrue(rejected.makefile("rb").readline().startswith("HTTP/1.1 503"))
+            for sock in (busy, queued, rejected):
+                sock.close()
+        finally:
+            srv.shutdown()
+            thread.join()
+            srv.server_close()
+
+    def test_pipelining_and_max_requests(self):
+        old, api.MainHTTPHandler.max_requests = api.MainHTTPHandler.max_requests, 2
+        try:
+            body = json.dumps(make_request(first_name="a", last_name="b"))
+            data = "POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+            sock = socket.create_connection(("localhost", self.port), timeout=5)
+            sock.sendall(data * 3)
+            rfile = sock.makefile("rb")
+            connection = []
+            for _ in range(2):
+                self.assertTrue(rfile.readline().startswith("HTTP/1.1 200"))
+                headers = dict(line.strip().split(": ", 1) for line in iter(rfile.readline, "\r\n"))
+                self.assertEqual(json.loads(rfile.read(int(headers["Content-Length"])))["code"], api.OK)
+                connection.append(headers.get("Connection"))
+            self.assertEqual(connection, [None, "close"])
+            self.assertEqual(rfile.read(), "")
+            sock.close()
+        finally:
+            api.MainHTTPHandler.max_requests = old
+
+
+    def test_idle_connections_do_not_hold_threads(self):
+        body = json.dumps(make_request(first_name="a", last_name="b"))
+        connections = []
+        try:
+            # Каждое соединение остаётся открытым после ответа, но следующее всё равно обслуживается сразу
+            for _ in range(self.server.threads + 1):
+                conn = httplib.HTTPConnection("localhost", self.port, timeout=2)
+                connections.append(conn)
+                started = time.time()
+                conn.request("POST", "/method/", body)
+                response = conn.getresponse()
+                self.assertEqual(response.status, api.OK)
+                self.assertEqual(json.loads(response.read())["response"], {"score": 0.5})
+                self.assertLess(time.time() - started, 1)
+            for conn in connections:
+                conn.request("POST", "/method/", body)
+                self.assertEqual(conn.getresponse().status, api.OK)
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def test_max_requests_across_idle_periods(self):
+        old, api.MainHTTPHandler.max_requests = api.MainHTTPHandler.max_requests, 2
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port, timeout=5)
+            connection = []
+            for _ in range(2):
+                conn.request("POST", "/method/", json.dumps(make_request(first_name="a", last_name="b")))
+                response = conn.getresponse()
+                response.read()
+                connection.append(response.getheader("Connection"))
+                time.sleep(0.05)
+            conn.close()
+        finally:
+            api.MainHTTPHandler.max_requests = old
+        self.assertEqual(connection, [None, "close"])
+
+    def test_idle_timeout(self):
+        old, api.MainHTTPHandler.timeout = api.MainHTTPHandler.timeout, 0.2
+        try:
+            sock = socket.create_connection(("localhost", self.port), timeout=5)
+            body = json.dumps(make_request(first_name="a", last_name="b"))
+            sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            status, headers, _ = self.read_response(sock)
+            self.assertEqual(status, api.OK)
+            started = time.time()
+            self.assertEqual(sock.recv(1), "")
+            self.assertLess(time.time() - started, 3)
+            sock.close()
+        finally:
+            api.MainHTTPHandler.timeout = old
+
+
+class TestTakeBuffered(unittest.TestCase):
+    def test_rest_stays_in_rfile(self):
+        # Опирается на буфер socket._fileobject Python 2.7: данные после заголовков читаются вместе с ними
+        client, peer = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(peer.close)
+        rfile = socket._fileobject(peer, "rb", -1)
+        client.sendall("HEAD\r\nbodyNEXT\r\n")
+        self.assertEqual(rfile.readline(), "HEAD\r\n")
+        self.assertTrue(api.has_buffered(rfile))
+        self.assertEqual(api.take_buffered(rfile, 4), "body")
+        self.assertEqual(rfile.readline(), "NEXT\r\n")
+        self.assertFalse(api.has_buffered(rfile))
+        self.assertEqual(api.take_buffered(rfile, 4), "")
+
+
+class TestSingleThreadServer(unittest.TestCase):
+    def setUp(self):
+        self.server = server.make_server(("localhost", 0), api.MainHTTPHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_connection_closed_after_response(self):
+        body = json.dumps(make_request(first_name="a", last_name="b"))
+        first = httplib.HTTPConnection("localhost", self.port, timeout=5)
+        first.request("POST", "/method/", body)
+        response = first.getresponse()
+        self.assertEqual(response.status, api.OK)
+        self.assertEqual(response.getheader("Connection"), "close")
+        response.read()
+        # Первый клиент не закрывает соединение, но второй всё равно получает ответ
+        second = httplib.HTTPConnection("localhost", self.port, timeout=2)
+        second.request("POST", "/method/", body)
+        self.assertEqual(second.getresponse().status, api.OK)
+        second.close()
+        first.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
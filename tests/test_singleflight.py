@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+from scoring_api.metrics import registry
+from scoring_api.singleflight import SingleFlight
+
+
+def coalesced(name, result):
+    return registry.collect()[0].get(("scoring_coalesced_total", (("lookup", name), ("result", result))), 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def run_followers(self, flight, target, count):
+        # Запускает count потоков и ждёт, пока все они станут ждать результата ведущего
+        shared = coalesced(flight.name, "shared")
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 5
+        while coalesced(flight.name, "shared") < shared + count and time.time() < deadline:
+            time.sleep(0.001)
+        return threads
+
+    def test_do_shares_result(self):
+        flight = SingleFlight("test_do")
+        release, calls, results = threading.Event(), [], []
+
+        def lookup(key):
+            calls.append(key)
+            release.wait()
+            return key * 2
+
+        leader = threading.Thread(target=lambda: results.append(flight.do(21, lookup, 21)))
+        leader.start()
+        while not flight.calls:
+            time.sleep(0.001)
+        followers = self.run_followers(flight, lambda: results.append(flight.do(21, lookup, 21)), 3)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 4)
+        self.assertEqual(flight.calls, {})
+        self.assertEqual(flight.do(21, lookup, 1), 2)
+
+    def test_do_shares_error(self):
+        flight = SingleFlight("test_error")
+        release, errors = threading.Event(), []
+
+        def lookup():
+            release.wait()
+            raise KeyError("boom")
+
+        def call():
+            try:
+                flight.do("k", lookup)
+            except KeyError, e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        while not flight.calls:
+            time.sleep(0.001)
+        followers = self.run_followers(flight, call, 2)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.calls, {})
+
+    def test_do_many(self):
+        flight = SingleFlight("test_many")
+        release, batches, results = threading.Event(), [], []
+
+        def lookup(keys):
+            batches.append(sorted(keys))
+            if len(batches) == 1:
+                release.wait()
+            return {key: -key for key in keys}
+
+        leader = threading.Thread(target=lambda: flight.do_many([1, 2], lookup))
+        leader.start()
+        while not flight.calls:
+            time.sleep(0.001)
+        follower = self.run_followers(flight, lambda: results.append(flight.do_many([2, 3, 3], lookup)), 1)[0]
+        while len(batches) < 2:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(batches, [[1, 2], [3]])
+        self.assertEqual(results, [{2: -2, 3: -3}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from scoring_api import snapshot, store, scoring
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, "cache.snap")
+
+    def test_write_and_load(self):
+        now = time.time()
+        items = [(5, now + 100, "5.0"), (3, float("inf"), "a"), (9, now - 1, "expired"), (5, now + 200, "1.0")]
+        self.assertEqual(snapshot.write_snapshot(self.filename, items), 2)
+        snap = snapshot.Snapshot.load(self.filename)
+        self.assertEqual(len(snap), 2)
+        self.assertEqual(snap.get(5), (now + 200, "1.0"))
+        self.assertEqual(snap.get(3), (float("inf"), "a"))
+        self.assertIsNone(snap.get(9))
+        self.assertIsNone(snap.get(100))
+        self.assertEqual([h for h, _, _ in snap.items()], [3, 5])
+
+    def test_max_entries(self):
+        now = time.time()
+        snapshot.write_snapshot(self.filename, [(i, now + i, str(i)) for i in range(1, 11)], max_entries=3)
+        self.assertEqual(sorted(h for h, _, _ in snapshot.Snapshot.load(self.filename).items()), [8, 9, 10])
+
+    def test_missing_and_corrupted(self):
+        self.assertIsNone(snapshot.Snapshot.load(self.filename))
+        with open(self.filename, "wb") as f:
+            f.write("garbage")
+        self.assertIsNone(snapshot.SnapshotStore(store.LRUStore(), self.filename, interval=0).snapshot)
+
+    def test_warm_start(self):
+        args = ("79175002040", "a@b.ru")
+        key = scoring.get_score_key(*args)
+        first = snapshot.SnapshotStore(store.LRUStore(), self.filename, interval=0)
+        first.cache_set(key, 1.0, 60)
+        first.cache_set("expired", 2.0, 0.01)
+        time.sleep(0.02)
+        self.assertEqual(first.save(), 1)
+
+        backend = store.LRUStore()
+        second = snapshot.SnapshotStore(backend, self.filename, interval=0)
+        self.assertIsNone(backend.cache_get(key))
+        self.assertEqual(scoring.get_score(second, *args), 1.0)
+        # Запись перенесена в кэш процесса с оставшимся сроком жизни
+        self.assertEqual(backend.cache_get(key), "1.0")
+        self.assertLessEqual(backend.cache.data[key][1], time.time() + 60)
+        self.assertIsNone(second.cache_get("expired"))
+
+    def test_save_merges_processes(self):
+        first = snapshot.SnapshotStore(store.LRUStore(), self.filename, interval=0)
+        second = snapshot.SnapshotStore(store.LRUStore(), self.filename, interval=0)
+        first.cache_set("a", 1.0)
+        second.cache_set("b", 2.0)
+        first.save()
+        self.assertEqual(second.save(), 2)
+        self.assertEqual(first.cache_get("b"), None)
+        third = snapshot.SnapshotStore(store.LRUStore(), self.filename, interval=0)
+        self.assertEqual((third.cache_get("a"), third.cache_get("b")), ("1.0", "2.0"))
+
+    def test_single_writer(self):
+        runs = []
+
+        class CountingStore(snapshot.SnapshotStore):
+            def run(self):
+                runs.append(threading.current_thread())
+
+        s = CountingStore(store.LRUStore(), self.filename, interval=3600)
+        threads = [threading.Thread(target=s.cache_get, args=("a",)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(runs), 1)
+
+    def test_shared_memory_backend(self):
+        first = snapshot.SnapshotStore(store.SharedMemoryStore(slots=64), self.filename, interval=0)
+        first.cache_set("a", 1.5, 60)
+        first.save()
+        second = snapshot.SnapshotStore(store.SharedMemoryStore(slots=64), self.filename, interval=0)
+        self.assertEqual(second.cache_get("a"), "1.5")
+        self.assertEqual(second.backend.cache_get("a"), "1.5")
+
+
+if __name__ == "__main__":
+    unittest.main()
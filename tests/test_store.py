@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import shutil
+import tempfile
+import socket
+import threading
+import unittest
+import SocketServer
+
+from scoring_api import store, scoring
+from scoring_api.lru import LRUCache
+
+
+class FakeRedisHandler(SocketServer.StreamRequestHandler):
+    """Local stand-in for a Redis server that understands GET, SET and MGET."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def bulk(value):
+        if value is None:
+            return "$-1\r\n"
+        return "$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            self.server.commands.append(args)
+            command = args[0].upper()
+            if command == "GET":
+                reply = self.bulk(data.get(args[1]))
+            elif command == "SET":
+                data[args[1]] = args[2]
+                reply = "+OK\r\n"
+            elif command == "MGET":
+                reply = "*%d\r\n" % (len(args) - 1) + "".join(self.bulk(data.get(k)) for k in args[1:])
+            else:
+                reply = "-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+class FakeRedisServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ("localhost", 0), FakeRedisHandler)
+        self.data = {}
+        self.commands = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = LRUCache()
+        cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+
+class TestLRUStore(unittest.TestCase):
+    def test_interests_stub_without_data(self):
+        s = store.make_store()
+        interests = scoring.get_interests_many(s, [1, 2])
+        self.assertEqual(sorted(interests), [1, 2])
+        self.assertTrue(all(len(v) == 2 and set(v) <= set(scoring.INTERESTS) for v in interests.values()))
+        s.set("i:1", json.dumps(["cars"]))
+        self.assertEqual(scoring.get_interests_many(s, [1, 2]), {1: ["cars"], 2: []})
+
+
+class TestSocketStore(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        self.store = store.SocketStore(*self.server.server_address, retries=1, retry_delay=0)
+
+    def tearDown(self):
+        self.store.close()
+        self.server.stop()
+
+    def test_get_and_cache(self):
+        self.server.data["i:1"] = json.dumps(["cars"])
+        self.assertEqual(scoring.get_interests(self.store, 1), ["cars"])
+        self.assertEqual(scoring.get_interests(self.store, 2), [])
+        self.store.cache_set("key", u"value", 60)
+        self.assertEqual(self.store.cache_get("key"), "value")
+        self.assertEqual(self.server.commands[-2], ["SET", "key", "value", "EX", "60"])
+
+    def test_get_interests_many(self):
+        self.server.data["i:1"] = json.dumps(["cars"])
+        self.server.data["i:3"] = json.dumps(["pets"])
+        interests = scoring.get_interests_many(self.store, [1, 2, 3, 1, 3], chunk_size=2)
+        self.assertEqual(interests, {1: ["cars"], 2: [], 3: ["pets"]})
+        self.assertEqual(self.server.commands, [["MGET", "i:1", "i:2"], ["MGET", "i:3"]])
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.store.get("key")
+        self.assertEqual(self.store.pool.qsize(), 1)
+
+    def test_reconnect_after_server_drop(self):
+        self.store.get("key")
+        self.store.pool.queue[0].sock.shutdown(socket.SHUT_RDWR)
+        self.server.data["key"] = "value"
+        self.assertEqual(self.store.get("key"), "value")
+
+
+class TestUnavailableStore(unittest.TestCase):
+    def setUp(self):
+        self.store = store.SocketStore("localhost", free_port(), timeout=0.1, retries=2, retry_delay=0)
+
+    def test_get_raises(self):
+        with self.assertRaises(store.StoreError):
+            self.store.get("i:1")
+
+    def test_score_survives_cache_failure(self):
+        self.assertEqual(scoring.get_score(self.store, "79175002040", "a@b.ru"), 3.0)
+
+
+class TestScoreCache(unittest.TestCase):
+    def test_score_is_memoized(self):
+        s = store.LRUStore()
+        args = ("79175002040", "a@b.ru", "01.01.2000", 1, "a", "b")
+        self.assertEqual(scoring.get_score(s, *args), 5.0)
+        s.cache_set(scoring.get_score_key(*args), 1.0)
+        self.assertEqual(scoring.get_score(s, *args), 1.0)
+        self.assertNotEqual(scoring.get_score_key(*args), scoring.get_score_key("79175002040", "a@b.ru"))
+
+
+class TestSharedMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.backend = store.LRUStore()
+        self.backend.set("i:1", json.dumps(["cars"]))
+        self.store = store.SharedMemoryStore(self.backend, slots=64)
+
+    def test_get_and_cache(self):
+        self.assertEqual(self.store.get("i:1"), json.dumps(["cars"]))
+        self.assertIsNone(self.store.cache_get("a"))
+        self.store.cache_set("a", 3.5)
+        self.store.cache_set(u"b", u"x")
+        self.assertEqual(self.store.cache_get("a"), "3.5")
+        self.assertEqual(self.store.cache_get("b"), "x")
+        self.store.cache_set("a", 1.0)
+        self.assertEqual(self.store.cache_get("a"), "1.0")
+
+    def test_ttl(self):
+        self.store.cache_set("a", 1.0, ttl=0.05)
+        self.assertEqual(self.store.cache_get("a"), "1.0")
+        time.sleep(0.1)
+        self.assertIsNone(self.store.cache_get("a"))
+
+    def test_large_value_not_cached(self):
+        self.store.cache_set("a", "x" * (store.SharedMemoryStore.VALUE_SIZE + 1))
+        self.assertIsNone(self.store.cache_get("a"))
+
+    def test_eviction(self):
+        s = store.SharedMemoryStore(self.backend, slots=4)
+        for i in range(20):
+            s.cache_set("k%d" % i, i, ttl=100 + i)
+        self.assertEqual(s.cache_get("k19"), "19")
+        self.assertLessEqual(sum(s.cache_get("k%d" % i) is not None for i in range(20)), 4)
+
+    def test_corrupted_slot_is_miss(self):
+        self.store.cache_set("a", 1.0)
+        offset = self.store.offset(self.store.key_hash("a"), 0)
+        self.store.buf[offset + store.SharedMemoryStore.SLOT.size] = "9"
+        self.assertIsNone(self.store.cache_get("a"))
+
+    def test_shared_with_forked_process(self):
+        pid = os.fork()
+        if pid == 0:
+            self.store.cache_set("child", 2.0)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.store.cache_get("child"), "2.0")
+
+    def test_file_attach(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, "cache")
+        first = store.SharedMemoryStore(self.backend, slots=64, filename=filename)
+        first.cache_set("a", 1.0)
+        self.assertEqual(store.SharedMemoryStore(slots=64, filename=filename).cache_get("a"), "1.0")
+        # Файл с другой разметкой не размечается заново: им пользуются другие процессы
+        with self.assertRaises(ValueError):
+            store.SharedMemoryStore(slots=32, filename=filename)
+        self.assertEqual(first.cache_get("a"), "1.0")
+
+    def test_make_store(self):
+        self.assertIsInstance(store.make_store(), store.LRUStore)
+        s = store.make_store(shared_cache=16)
+        self.assertIsInstance(s, store.SharedMemoryStore)
+        self.assertIsInstance(s.backend, store.LRUStore)
+
+
+if __name__ == "__main__":
+    unittest.main()